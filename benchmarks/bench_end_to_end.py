@@ -0,0 +1,164 @@
+"""
+End-to-end throughput of mapillary_download.py and get_data's get_metadata
+against a local fake Mapillary (Graph API + image CDN) and an in-process S3,
+for several worker counts: images/s, p50/p99 latency, throttled calls and
+peak RSS.
+
+    python benchmarks/bench_end_to_end.py --images 2000 --workers 4,8,16 \
+        --graph_latency_ms 80 --cdn_latency_ms 40 --error_429 0.01 --error_5xx 0.005
+
+Each run is a separate subprocess (peak RSS is per run); the fake servers
+live in the parent process. Runs use a fresh metadata cache, so nothing is
+answered locally.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fakes import FakeS3, image_ids, images_bbox, sequence_ids, serve_mapillary  # noqa: E402
+
+# the histogram whose percentiles are reported for each target
+LATENCY_METRIC = {"download": "transfer_seconds", "metadata": "graph_request_seconds"}
+# --buffered downloads and uploads in separate stages, timed by their own histograms (no transfer_seconds)
+BUFFERED_LATENCY_METRICS = ("download_seconds", "upload_seconds")
+
+
+def run_download(args, workers, tmp):
+    import mapillary_download
+
+    mapillary_download.s3_client = FakeS3(latency=args.s3_latency_ms / 1000)
+    metrics_path = os.path.join(tmp, "metrics.json")
+    argv = ["bench-token", "--overwrite", "--no_cache", "--report_interval", "0", "--metrics", metrics_path,
+            "--failures", os.path.join(tmp, "failures.jsonl"),
+            "--metadata_workers", str(workers), "--download_workers", str(workers),
+            "--upload_workers", str(workers), "--sequence_workers", str(workers),
+            "--rate", str(args.rate), "--max_rate", str(args.rate)]
+    if args.sequences:
+        argv += ["--sequence_ids"] + sequence_ids(args.sequences)
+    elif args.bbox:
+        argv += ["--bbox", ",".join(map(str, images_bbox(args.images))), "--bbox_workers", str(workers),
+                 "--tile_size", str(args.tile_size)]
+    else:
+        ids_file = os.path.join(tmp, "ids.txt")
+        with open(ids_file, "w") as f:
+            f.write("\n".join(image_ids(args.images)))
+        argv += ["--ids_file", ids_file]
+    if args.buffered:
+        argv.append("--buffered")
+
+    start = time.monotonic()
+    mapillary_download.main(argv)
+    elapsed = time.monotonic() - start
+    with open(metrics_path) as f:
+        metrics = json.load(f)
+    return elapsed, metrics.get("images_uploaded_total", 0), metrics
+
+
+def run_metadata(args, workers, tmp):
+    sys.path.insert(0, os.path.join(ROOT, "get_data"))
+    import global_conf
+
+    # data_functions copies these at import time
+    global_conf.SAVE_PATH = os.path.join(tmp, "out.csv")
+    global_conf.JOURNAL_PATH = os.path.join(tmp, "journal.jsonl")
+    global_conf.CACHE_PATH = os.path.join(tmp, "cache.sqlite")
+    global_conf.METRICS_PATH = os.path.join(tmp, "metrics.json")
+    global_conf.ACCESS_TOKENS = ["bench-token"]
+    global_conf.FETCH_WORKERS = workers
+    global_conf.RATE_PER_TOKEN = global_conf.MAX_RATE_PER_TOKEN = args.rate
+    global_conf.REPORT_INTERVAL = 0
+    import data_functions
+
+    start = time.monotonic()
+    data_functions.get_metadata([f"{image_id}.jpg" for image_id in image_ids(args.images)])
+    elapsed = time.monotonic() - start
+    with open(global_conf.METRICS_PATH) as f:
+        metrics = json.load(f)
+    return elapsed, metrics.get("lookups_total", 0), metrics
+
+
+def run_child(args):
+    runner = run_download if args.child == "download" else run_metadata
+    with tempfile.TemporaryDirectory() as tmp:
+        elapsed, images, metrics = runner(args, args.child_workers, tmp)
+    latency, upload = metrics.get(LATENCY_METRIC[args.child], {}), None
+    if args.child == "download" and args.buffered:
+        latency, upload = (metrics.get(name, {}) for name in BUFFERED_LATENCY_METRICS)
+    result = {
+        "target": args.child,
+        "workers": args.child_workers,
+        "images": images,
+        "images_per_s": round(images / elapsed, 1),
+        "p50_ms": round(1000 * latency.get("p50", float("nan")), 1),
+        "p99_ms": round(1000 * latency.get("p99", float("nan")), 1),
+        "throttled": metrics.get("graph_throttled_total", 0),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    if upload is not None:
+        result["upload_p50_ms"] = round(1000 * upload.get("p50", float("nan")), 1)
+        result["upload_p99_ms"] = round(1000 * upload.get("p99", float("nan")), 1)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=2000)
+    parser.add_argument('--sequences', type=int, default=0,
+                        help='Download through --sequence_ids: this many sequences of --images images each')
+    parser.add_argument('--bbox', action='store_true',
+                        help='Download through --bbox: a box holding the --images images, searched in tiles')
+    parser.add_argument('--tile_size', type=float, default=0.005)
+    parser.add_argument('--workers', type=str, default='4,8,16', help='Comma-separated worker counts to compare')
+    parser.add_argument('--targets', type=str, default='download,metadata')
+    parser.add_argument('--size_kb', type=int, default=300)
+    parser.add_argument('--graph_latency_ms', type=float, default=50)
+    parser.add_argument('--cdn_latency_ms', type=float, default=30)
+    parser.add_argument('--s3_latency_ms', type=float, default=20)
+    parser.add_argument('--error_429', type=float, default=0.0)
+    parser.add_argument('--error_5xx', type=float, default=0.0)
+    parser.add_argument('--rate', type=float, default=100, help='Graph API calls/s allowed per token')
+    parser.add_argument('--buffered', action='store_true')
+    parser.add_argument('--child', choices=list(LATENCY_METRIC), help=argparse.SUPPRESS)
+    parser.add_argument('--child_workers', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        # child process: the fake server URL comes in MAPILLARY_GRAPH_URL
+        print(json.dumps(run_child(args)))
+        return
+
+    server, base_url = serve_mapillary(
+        args.size_kb * 1024, images_per_sequence=args.images if args.sequences else 0,
+        graph_latency=args.graph_latency_ms / 1000, cdn_latency=args.cdn_latency_ms / 1000,
+        error_429=args.error_429, error_5xx=args.error_5xx, searchable_images=args.images)
+    env = {**os.environ, "MAPILLARY_GRAPH_URL": base_url}
+    print(f"{args.images * max(args.sequences, 1)} images x {args.size_kb} KB, graph {args.graph_latency_ms} ms, "
+          f"CDN {args.cdn_latency_ms} ms, S3 {args.s3_latency_ms} ms, 429 {args.error_429:.1%}, "
+          f"5xx {args.error_5xx:.1%}")
+    # with --buffered the download p50/p99 time the CDN fetch alone, the upload ones follow
+    uploads = f" {'up p50':>8} {'up p99':>8}" if args.buffered else ''
+    print(f"{'target':>10} {'workers':>8} {'images/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'429s':>6} {'peak MB':>8}"
+          + uploads)
+    try:
+        for target in args.targets.split(','):
+            for workers in map(int, args.workers.split(',')):
+                out = subprocess.run([sys.executable, __file__, '--child', target, '--child_workers', str(workers)]
+                                     + sys.argv[1:], env=env, check=True, capture_output=True, text=True).stdout
+                r = json.loads(out.strip().splitlines()[-1])
+                uploads = f" {r.get('upload_p50_ms', ''):>8} {r.get('upload_p99_ms', ''):>8}" if args.buffered else ''
+                print(f"{r['target']:>10} {r['workers']:>8} {r['images_per_s']:>10} {r['p50_ms']:>8} "
+                      f"{r['p99_ms']:>8} {r['throttled']:>6} {r['peak_rss_mb']:>8}" + uploads)
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
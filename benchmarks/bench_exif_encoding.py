@@ -0,0 +1,77 @@
+"""
+Per-image EXIF value encoding (writePictureMetadata + add_altitude + add_direction)
+against Writer.encode_batch on a synthetic sequence; also checks both give the same tags.
+
+    python benchmarks/bench_exif_encoding.py --images 5000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from writer import PictureMetadata, Writer  # noqa: E402
+
+
+def per_image(metadatas):
+    results = []
+    for metadata in metadatas:
+        writer = Writer.__new__(Writer)  # no image needed to compute the values
+        writer.exif, writer.updated_exif, writer.updated_xmp = {}, {}, {}
+        writer.writePictureMetadata(metadata)
+        writer.add_altitude(metadata)
+        writer.add_direction(metadata)
+        results.append(writer.updated_exif)
+    return results
+
+
+def sequence(count, seed):
+    rng = random.Random(seed)
+    lat, lon = rng.uniform(-60, 70), rng.uniform(-180, 180)
+    start = datetime(2023, 3, 26, 0, 30) + timedelta(seconds=rng.randrange(10 ** 7))
+    rows = []
+    for i in range(count):
+        lat += rng.uniform(-2e-5, 2e-5)
+        lon += rng.uniform(-2e-5, 2e-5)
+        rows.append(dict(
+            latitude=lat, longitude=lon,
+            altitude=rng.uniform(-20, 3000) if i % 7 else None,
+            direction=rng.uniform(-30, 400) if i % 5 else None,
+            capture_time=start + timedelta(seconds=2 * i, microseconds=rng.randrange(10 ** 6) if i % 3 else 0),
+        ))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=5000)
+    parser.add_argument('--sequences', type=int, default=10)
+    args = parser.parse_args()
+
+    rows = []
+    for seed in range(args.sequences):
+        rows += sequence(args.images // args.sequences, seed)
+
+    start = time.perf_counter()
+    expected = per_image([PictureMetadata(**row) for row in rows])
+    scalar = time.perf_counter() - start
+
+    start = time.perf_counter()
+    got = Writer.encode_batch(
+        [row['latitude'] for row in rows], [row['longitude'] for row in rows],
+        altitudes=[row['altitude'] for row in rows], directions=[row['direction'] for row in rows],
+        capture_times=[row['capture_time'] for row in rows],
+    )
+    batch = time.perf_counter() - start
+
+    mismatches = sum(a != b for a, b in zip(expected, got))
+    print(f"{len(rows)} images: per-image {1e6 * scalar / len(rows):.1f} us/image, "
+          f"batch {1e6 * batch / len(rows):.1f} us/image, {mismatches} mismatching images")
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
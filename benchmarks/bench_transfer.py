@@ -0,0 +1,79 @@
+"""
+Compare the buffered CDN -> S3 path (whole image in memory, then upload) with
+the streaming multipart path: peak RSS and MB/s.
+
+    python benchmarks/bench_transfer.py --images 64 --size_mb 24 --workers 16
+
+Each mode runs in its own subprocess so that peak RSS is measured separately.
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fakes import FakeS3, serve_payload  # noqa: E402
+
+
+def run_mode(mode, images, size, workers, chunk_size, part_size):
+    import mapillary_download
+
+    mapillary_download.s3_client = FakeS3()
+    mapillary_download.configure_session(workers)
+    server, base_url = serve_payload(size)
+
+    def buffered(i):
+        mapillary_download.upload(mapillary_download.download(f"{base_url}/{i}.jpg"), "bench", f"{i}.jpg")
+
+    def streaming(i):
+        mapillary_download.transfer(f"{base_url}/{i}.jpg", "bench", f"{i}.jpg",
+                                    chunk_size=chunk_size, part_size=part_size)
+
+    job = buffered if mode == "buffered" else streaming
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(job, range(images)))
+    elapsed = time.monotonic() - start
+    server.shutdown()
+
+    peak_kib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "mode": mode,
+        "seconds": round(elapsed, 3),
+        "mb_per_s": round(images * size / 1e6 / elapsed, 1),
+        "peak_rss_mb": round(peak_kib / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=64)
+    parser.add_argument('--size_mb', type=float, default=24)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--chunk_kb', type=int, default=256)
+    parser.add_argument('--part_mb', type=int, default=8)
+    parser.add_argument('--mode', choices=['buffered', 'streaming'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    size = int(args.size_mb * 1024 * 1024)
+    if args.mode:
+        # child process: run a single mode and report as JSON
+        print(json.dumps(run_mode(args.mode, args.images, size, args.workers,
+                                  args.chunk_kb * 1024, args.part_mb * 1024 * 1024)))
+        return
+
+    print(f"{args.images} images x {args.size_mb} MB, {args.workers} workers")
+    for mode in ('buffered', 'streaming'):
+        out = subprocess.run([sys.executable, __file__, '--mode', mode] + sys.argv[1:],
+                             check=True, capture_output=True, text=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        print(f"{result['mode']:>10}: {result['mb_per_s']:>8} MB/s  peak RSS {result['peak_rss_mb']:>8} MB")
+
+
+if __name__ == '__main__':
+    main()
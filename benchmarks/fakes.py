@@ -0,0 +1,229 @@
+"""
+Local stand-ins used by the benchmarks: an HTTP server serving image payloads,
+a fake Mapillary (Graph API + image CDN) and an in-process S3 client that
+accepts uploads without keeping them.
+"""
+import itertools
+import json
+import math
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+IMAGE_ID_BASE = 10 ** 12
+SEQUENCE_SIZE = 10 ** 6  # image IDs of sequence k are IMAGE_ID_BASE + k * SEQUENCE_SIZE + i
+# image IMAGE_ID_BASE + i lies at (ORIGIN[0] + i * STEP, ORIGIN[1] + i * STEP), on a diagonal
+ORIGIN = (2.35, 48.85)
+STEP = 1e-5
+CAPTURED_AT = 1700000000000  # ms, capture time of image IMAGE_ID_BASE; one image per second after it
+
+
+class FakeS3:
+    """Implements the subset of the boto3 S3 client used by the downloader; object bodies are discarded."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency  # seconds added to every call
+        self.lock = threading.Lock()
+        self.objects = {}  # key -> size
+        self.upload_ids = itertools.count(1)
+        self.uploads = {}
+
+    @staticmethod
+    def _size(body):
+        if hasattr(body, "read"):
+            size = 0
+            while True:
+                chunk = body.read(1024 * 1024)
+                if not chunk:
+                    return size
+                size += len(chunk)
+        return len(body)
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def put_object(self, Bucket, Key, Body=b"", **kwargs):
+        self._wait()
+        size = self._size(Body)
+        with self.lock:
+            self.objects[(Bucket, Key)] = size
+        return {"ETag": '"fake"'}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, **kwargs):
+        self.put_object(Bucket, Key, Fileobj)
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        with self.lock:
+            upload_id = str(next(self.upload_ids))
+            self.uploads[upload_id] = 0
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self._wait()
+        size = self._size(Body)
+        with self.lock:
+            self.uploads[UploadId] += size
+        return {"ETag": f'"part-{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        with self.lock:
+            self.objects[(Bucket, Key)] = self.uploads.pop(UploadId)
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+        return {}
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass  # clients going away mid-answer (e.g. a finished benchmark run) are expected
+
+
+def image_ids(count):
+    """IDs of `count` images known to serve_mapillary."""
+    return [str(IMAGE_ID_BASE + i) for i in range(count)]
+
+
+def images_bbox(count):
+    """Bounding box (west, south, east, north) holding the first `count` images of image_ids."""
+    return ORIGIN[0] - STEP / 2, ORIGIN[1] - STEP / 2, ORIGIN[0] + (count - 0.5) * STEP, ORIGIN[1] + (count - 0.5) * STEP
+
+
+def sequence_ids(count):
+    return [f"seq{k}" for k in range(count)]
+
+
+def serve_mapillary(size, images_per_sequence=100, page_size=1000, graph_latency=0.0, cdn_latency=0.0,
+                    error_429=0.0, error_5xx=0.0, seed=0, searchable_images=0):
+    """
+    Start a fake Mapillary on a background HTTP server; returns (server, base_url).
+
+    Graph API shapes: `/?ids=a,b&fields=...`, `/{id}?fields=...` and
+    `/image_ids?sequence_id=seqK` (paged by `page_size`, with `paging.next`)
+    and `/images?bbox=...&limit=N[&start_captured_at=...]` over the first
+    `searchable_images` images (image i is captured at CAPTURED_AT + i s);
+    every image has a `thumb_*_url` on `/cdn/{id}.jpg`, which answers `size`
+    bytes. Every request waits `graph_latency` or `cdn_latency` seconds and
+    fails with a 429 or a 503 with probability `error_429` / `error_5xx`.
+    """
+    block = b"\xff" * (64 * 1024)
+    rng = random.Random(seed)
+    rng_lock = threading.Lock()
+
+    def image(base_url, image_id, fields=None):
+        index = int(image_id) - IMAGE_ID_BASE
+        url = f"{base_url}/cdn/{image_id}.jpg"
+        data = {
+            "id": image_id,
+            "computed_geometry": {"type": "Point", "coordinates": [ORIGIN[0] + index * STEP, ORIGIN[1] + index * STEP]},
+            "captured_at": CAPTURED_AT + index * 1000,
+            "compass_angle": float(index % 360),
+            "camera_type": "perspective",
+            "sequence": f"seq{index // SEQUENCE_SIZE}",
+            **{f"thumb_{resolution}_url": url for resolution in ("256", "1024", "2048", "original")},
+        }
+        if fields:
+            data = {field: value for field, value in data.items() if field == "id" or field in fields.split(",")}
+        return data
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def send_json(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            base_url = f"http://{self.headers['Host']}"
+            cdn = url.path.startswith("/cdn/")
+            time.sleep(cdn_latency if cdn else graph_latency)
+            with rng_lock:
+                draw = rng.random()
+            if draw < error_429:
+                return self.send_json(429, {"error": {"message": "Application request limit reached", "code": 4}})
+            if draw < error_429 + error_5xx:
+                return self.send_json(503, {"error": {"message": "Service unavailable", "code": 2}})
+
+            if cdn:
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(size))
+                self.end_headers()
+                remaining = size
+                while remaining > 0:
+                    n = min(remaining, len(block))
+                    self.wfile.write(block[:n])
+                    remaining -= n
+            elif url.path == "/image_ids":
+                k = int(query["sequence_id"].lstrip("seq"))
+                after = int(query.get("after", 0))
+                ids = [str(IMAGE_ID_BASE + k * SEQUENCE_SIZE + i)
+                       for i in range(after, min(after + page_size, images_per_sequence))]
+                body = {"data": [{"id": image_id} for image_id in ids]}
+                if after + page_size < images_per_sequence:
+                    body["paging"] = {"next": f"{base_url}/image_ids?sequence_id=seq{k}&after={after + page_size}"}
+                self.send_json(200, body)
+            elif url.path == "/images":
+                west, south, east, north = map(float, query["bbox"].split(","))
+                first = max(0, math.ceil((west - ORIGIN[0]) / STEP), math.ceil((south - ORIGIN[1]) / STEP))
+                if "start_captured_at" in query:
+                    start = datetime.strptime(query["start_captured_at"], "%Y-%m-%dT%H:%M:%S.%fZ")
+                    start_ms = round(start.replace(tzinfo=timezone.utc).timestamp() * 1000)
+                    first = max(first, math.ceil((start_ms - CAPTURED_AT) / 1000))
+                last = min(searchable_images - 1, math.floor((east - ORIGIN[0]) / STEP),
+                           math.floor((north - ORIGIN[1]) / STEP))
+                indexes = range(first, min(last + 1, first + int(query.get("limit", 2000))))
+                self.send_json(200, {"data": [image(base_url, str(IMAGE_ID_BASE + i), query.get("fields"))
+                                              for i in indexes]})
+            elif url.path == "/":
+                self.send_json(200, {image_id: image(base_url, image_id, query.get("fields"))
+                                     for image_id in query["ids"].split(",")})
+            else:
+                self.send_json(200, image(base_url, url.path.strip("/"), query.get("fields")))
+
+        def log_message(self, *args):
+            pass
+
+    server = QuietHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def serve_payload(size, chunk_size=64 * 1024):
+    """Start a background HTTP server answering every GET with `size` bytes; returns (server, base_url)."""
+    block = b"\xff" * chunk_size
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            remaining = size
+            while remaining > 0:
+                n = min(remaining, chunk_size)
+                self.wfile.write(block[:n])
+                remaining -= n
+
+        def log_message(self, *args):
+            pass
+
+    server = QuietHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
@@ -0,0 +1,96 @@
+"""
+Failure journal of mapillary_download.py, and the policies of --retry_failed.
+
+Every image (or sequence) that fails a pipeline stage is appended to a
+JSON Lines journal with the stage, the error class, the HTTP status when
+there is one, and how many times it failed so far. An item stored later
+gets a `resolved` record, so the latest record of each ID tells whether it
+still needs work, and a retry run only reads the journal: its cost follows
+the number of failures, not the size of the bucket.
+"""
+import threading
+import time
+from typing import Dict, List
+
+from graph_api import http_status
+from journal import Journal, iter_records
+
+DEFAULT_MAX_ATTEMPTS = 5
+
+# what --retry_failed does with a failure
+RETRY = 'retry'  # process the ID again
+REFRESH = 'refresh'  # forget its cached thumbnail URL first: signed URLs expire
+GIVE_UP = 'give_up'  # leave it in the journal
+
+# the CDN answers these to a thumbnail URL whose signature expired
+EXPIRED_URL_STATUSES = (403, 404, 410)
+# the Graph API answers these to an image that is gone or private; retrying would not help
+GONE_STATUSES = (400, 404)
+
+
+class MissingThumbnail(LookupError):
+    """The Graph API answered the image without the thumbnail URL asked for (e.g. still processing)."""
+
+
+def policy(record: dict, max_attempts: int = DEFAULT_MAX_ATTEMPTS) -> str:
+    if record['attempts'] >= max_attempts:
+        return GIVE_UP
+    status = record.get('status')
+    if record['stage'] in ('download', 'transfer') and status in EXPIRED_URL_STATUSES:
+        return REFRESH
+    if record['stage'] == 'metadata' and status in GONE_STATUSES:
+        return GIVE_UP
+    return RETRY
+
+
+class FailureLog:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.failed: Dict[str, dict] = {}  # ID -> latest record, for the IDs not resolved
+        self.lock = threading.Lock()
+        for record in iter_records(path):
+            if record.get('resolved'):
+                self.failed.pop(record['id'], None)
+            else:
+                self.failed[record['id']] = record
+        self.journal = Journal(path, fsync=False)
+
+    def close(self) -> None:
+        self.journal.close()
+
+    def record(self, item_id: str, stage: str, error: Exception, kind: str = 'image') -> None:
+        item_id = str(item_id)
+        with self.lock:
+            record = {
+                'id': item_id,
+                'kind': kind,
+                'stage': stage,
+                'error': type(error).__name__,
+                'status': http_status(error),
+                'attempts': self.failed.get(item_id, {}).get('attempts', 0) + 1,
+                'message': str(error)[:300],
+                'at': round(time.time(), 3),
+            }
+            self.failed[item_id] = record
+            self.journal.append(record)
+
+    def resolve(self, item_id: str) -> None:
+        item_id = str(item_id)
+        with self.lock:
+            if self.failed.pop(item_id, None) is not None:
+                self.journal.append({'id': item_id, 'resolved': True, 'at': round(time.time(), 3)})
+
+    def plan(self, max_attempts: int = DEFAULT_MAX_ATTEMPTS) -> Dict[str, List[dict]]:
+        """The unresolved failures grouped by policy."""
+        plan = {RETRY: [], REFRESH: [], GIVE_UP: []}
+        for record in self.failed.values():
+            plan[policy(record, max_attempts)].append(record)
+        return plan
+
+    def counts(self) -> Dict[str, int]:
+        """Unresolved failures per stage/error class, for the summary."""
+        counts = {}
+        for record in self.failed.values():
+            key = f"{record['stage']}/{record['error']}" + (f" {record['status']}" if record.get('status') else '')
+            counts[key] = counts.get(key, 0) + 1
+        return counts
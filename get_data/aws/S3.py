@@ -1,54 +1,184 @@
+import itertools
 import logging
 import os
+import queue
+import threading
+from collections import namedtuple
+from typing import TYPE_CHECKING
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 
 import boto3
-import pandas as pd
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+if TYPE_CHECKING:
+	import pandas as pd
 
 logging.basicConfig(level=logging.INFO)
 
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".tiff")
+LISTING_WORKERS = 10
+UPLOAD_WORKERS = 32
+UPLOAD_PART_WORKERS = 4  # threads per file once it is large enough for a multipart upload
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+_PARTITION_DONE = object()
+
+
+# splits the keys under prefix in contiguous ranges (after, upto] at the numeric prefixes of length depth;
+# keys are Mapillary IDs, so the ranges are about even. The first range is open below, the last open above,
+# so keys not starting with a digit are still listed
+def key_ranges(prefix: str = '', depth: int = 1, start_after: str = None):
+	bounds = [prefix + ''.join(d) for d in itertools.product('0123456789', repeat=depth)]
+	if start_after:
+		bounds = [bound for bound in bounds if bound > start_after]
+	return list(zip([start_after] + bounds, bounds + [None]))
+
+
+# outcome of one file of S3.upload_many; error is None when the upload succeeded
+UploadResult = namedtuple("UploadResult", ["local_path", "key", "size", "error"])
+
+
 class S3:
 	def __init__(self):
-		session = boto3.Session(
+		self.session = boto3.Session(
 			region_name='eu-central-1'
 		)
-		self.s3 = session.client('s3')
-
-	# writes to s3 bucket
-	def write(self, filenames: pd.Series, local_path: str, bucket_name: str, s3_folder: str = None, run_date: str = None):
-		for i, filename in enumerate(filenames):
-			local_file_path = os.path.join(local_path, str(filename))
-			if local_file_path == '/Users/ellabaruch/Documents/Ella/work/SampleData/Photos/nan':
-				continue
-			# s3_key = s3_folder + run_date + str(filename)
-			s3_key = str(filename)
-			self.s3.upload_file(local_file_path, bucket_name, s3_key)
-			logging.info(f"""Uploaded {filename} to s3 bucket {bucket_name}""")
+		self.s3 = self.session.client('s3')
+
+	# writes to s3 bucket, see upload_many; filenames that are empty or NaN are skipped
+	def write(self, filenames: 'pd.Series', local_path: str, bucket_name: str, s3_folder: str = None, run_date: str = None,
+			  workers: int = UPLOAD_WORKERS):
+		import pandas as pd  # only here: the downloader imports this module for the key index
+
+		# s3_key = s3_folder + run_date + str(filename)
+		items = ((os.path.join(local_path, str(filename)), str(filename))
+				 for filename in filenames if not pd.isna(filename) and str(filename).strip())
+		results = []
+		for result in self.upload_many(items, bucket_name, workers=workers):
+			if result.error is None:
+				logging.info(f"""Uploaded {result.key} to s3 bucket {bucket_name}""")
+			else:
+				logging.error(f"""Failed to upload {result.local_path}: {result.error!r}""")
+			results.append(result)
+		return results
+
+	# uploads (local_path, key) pairs concurrently with managed (multipart above multipart_threshold) uploads
+	# and yields an UploadResult per file, in completion order. The uploads share one client whose connection
+	# pool is sized to workers * part_workers; at most 2 * workers files are in flight, so items may be a
+	# long generator
+	def upload_many(self, items, bucket_name, workers: int = UPLOAD_WORKERS, part_workers: int = UPLOAD_PART_WORKERS,
+					multipart_threshold: int = MULTIPART_THRESHOLD, multipart_chunksize: int = MULTIPART_CHUNKSIZE):
+		client = self.session.client('s3', config=Config(max_pool_connections=workers * part_workers))
+		transfer_config = TransferConfig(multipart_threshold=multipart_threshold,
+										 multipart_chunksize=multipart_chunksize,
+										 max_concurrency=part_workers)
+
+		def upload(local_path, key):
+			try:
+				size = os.path.getsize(local_path)
+				client.upload_file(local_path, bucket_name, key, Config=transfer_config)
+				return UploadResult(local_path, key, size, None)
+			except Exception as e:
+				return UploadResult(local_path, key, None, e)
+
+		items = iter(items)
+		with ThreadPoolExecutor(max_workers=workers) as pool:
+			in_flight = set()
+			for local_path, key in items:
+				in_flight.add(pool.submit(upload, local_path, key))
+				if len(in_flight) >= 2 * workers:
+					done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+					for future in done:
+						yield future.result()
+			for future in as_completed(in_flight):
+				yield future.result()
 
 	# returns list of filenames in bucket
 	def list_files(self, bucket_name):
 		logging.info(f"""--------------------listing files in bucket {bucket_name}""")
+		filenames = list(self.iter_files(bucket_name))
+		logging.info(f"""--------------------done listing files in bucket {bucket_name}""")
+
+		return filenames
+
+	# yields the keys in bucket (under prefix, after start_after) page by page, in lexicographic order
+	def iter_files(self, bucket_name, prefix: str = '', start_after: str = None):
+		params = {"Bucket": bucket_name, "Prefix": prefix}
+		if start_after:
+			params["StartAfter"] = start_after
 		paginator = self.s3.get_paginator("list_objects_v2")
-		page_iterator = paginator.paginate(Bucket=bucket_name)
 
-		filenames = []
+		for page in paginator.paginate(**params):
+			for obj in page.get("Contents", []):
+				yield obj["Key"]
 
-		for page in page_iterator:
-			if "Contents" in page:
-				for obj in page["Contents"]:
-					filenames.append(obj["Key"])
+	# yields the keys of one range (after, upto] under prefix, page by page
+	def _iter_range(self, bucket_name, prefix, after, upto, stop: threading.Event):
+		params = {"Bucket": bucket_name, "Prefix": prefix}
+		if after:
+			params["StartAfter"] = after
+		paginator = self.s3.get_paginator("list_objects_v2")
 
-		logging.info(f"""--------------------done listing files in bucket {bucket_name}""")
+		for page in paginator.paginate(**params):
+			keys = [obj["Key"] for obj in page.get("Contents", [])]
+			if upto is not None and keys and keys[-1] > upto:
+				yield [key for key in keys if key <= upto]
+				return
+			yield keys
+			if stop.is_set():
+				return
 
-		return filenames
+	# yields the keys in bucket (under prefix, after start_after), listing the key ranges of key_ranges
+	# concurrently; keys come in completion order, or with ordered in lexicographic order (each range is read
+	# back in turn while the next ones are listed ahead). At most 2 * workers pages are held in memory, and
+	# closing the generator stops the listing
+	def iter_files_parallel(self, bucket_name, prefix: str = '', start_after: str = None, depth: int = 1,
+							workers: int = LISTING_WORKERS, ordered: bool = False):
+		ranges = key_ranges(prefix, depth, start_after)
+		# one queue per range, read in range order, or one queue shared by every range
+		queues = [queue.Queue(maxsize=2) for _ in ranges] if ordered else [queue.Queue(maxsize=2 * workers)] * len(ranges)
+		stop = threading.Event()
+
+		def put(pages, item):
+			while not stop.is_set():
+				try:
+					pages.put(item, timeout=0.1)
+					return
+				except queue.Full:
+					continue
+
+		def list_range(pages, after, upto):
+			try:
+				for keys in self._iter_range(bucket_name, prefix, after, upto, stop):
+					put(pages, keys)
+			except Exception as e:
+				put(pages, e)
+			finally:
+				put(pages, _PARTITION_DONE)
 
-	# returns amount of files in bucket
+		# ranges start in order, so the one read next is always listing, never waiting for a worker
+		sources = [(pages, 1) for pages in queues] if ordered else [(queues[0], len(ranges))]
+		with ThreadPoolExecutor(max_workers=workers) as pool:
+			for pages, (after, upto) in zip(queues, ranges):
+				pool.submit(list_range, pages, after, upto)
+			try:
+				for pages, remaining in sources:
+					while remaining:
+						item = pages.get()
+						if item is _PARTITION_DONE:
+							remaining -= 1
+						elif isinstance(item, Exception):
+							raise item
+						else:
+							yield from item
+			finally:
+				stop.set()
+
+	# returns amount of image files in bucket
 	def count_files(self, bucket_name):
 		logging.info(f"""--------------------Counting total images in bucket""")
-		paginator = self.s3.get_paginator("list_objects_v2")
-		count = 0
+		count = sum(1 for key in self.iter_files_parallel(bucket_name) if key.lower().endswith(IMAGE_EXTENSIONS))
+		logging.info(f"""--------------------Total images in bucket '{bucket_name}': {count}""")
 
-		for page in paginator.paginate(Bucket=bucket_name):
-			for obj in page.get("Contents", []):
-				if obj["Key"].lower().endswith((".jpg", ".jpeg", ".png", ".gif", ".webp", ".tiff")):
-					count += 1
-		logging.info(f"""--------------------Total images in bucket '{bucket_name}': {count}""")
\ No newline at end of file
+		return count
\ No newline at end of file
@@ -1,31 +1,58 @@
 import os
+import sys
 import time
 
 import pandas as pd
 import requests
 
-from global_conf import RETRY_ATTEMPTS, RETRY_BACKOFF, CONNECTION_TIMEOUT, ACCESS_TOKEN, SAVE_PATH, CHECKPOINT_EVERY, \
-    SLEEP_BETWEEN_CALLS, BASE
+from global_conf import RETRY_ATTEMPTS, RETRY_BACKOFF, CONNECTION_TIMEOUT, ACCESS_TOKENS, SAVE_PATH, CHECKPOINT_EVERY, \
+    RATE_PER_TOKEN, MAX_RATE_PER_TOKEN, BATCH_SIZE, FETCH_WORKERS, CACHE_PATH, THUMB_URL_TTL, JOURNAL_PATH, \
+    METRICS_PATH, REPORT_INTERVAL, GEOHASH_PRECISION, ROW_GROUP_SIZE
+
+# the Graph API helpers are shared with mapillary_download.py at the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from graph_api import GraphAPIError, error_code, iter_image_data  # noqa: E402
+from journal import Journal, iter_records  # noqa: E402
+from metadata_cache import MetadataCache  # noqa: E402
+from metrics import Reporter, registry  # noqa: E402
+from parquet_export import ParquetExporter  # noqa: E402
+from rate_limit import TokenPool, is_invalid_token, is_throttled  # noqa: E402
+
+IMAGE_INFO_FIELDS = "id,computed_geometry,thumb_1024_url"
+OUTPUT_COLUMNS = ["image_id", "image_name", "lat", "lon", "url"]
+
+# every call goes through the pool: it picks the access token and paces calls to what the API accepts
+token_pool = TokenPool(ACCESS_TOKENS, rate=RATE_PER_TOKEN, max_rate=MAX_RATE_PER_TOKEN)
 
 
 def safe_get(url, params, retries=RETRY_ATTEMPTS, backoff=RETRY_BACKOFF):
-    """GET with retry/backoff on transient errors."""
+    """GET with an access token from the pool, retry/backoff on transient errors."""
     for attempt in range(retries):
+        if attempt:
+            registry.counter("graph_retries_total").inc()
+        token = token_pool.acquire()
         try:
-            r = requests.get(url, params=params, timeout=CONNECTION_TIMEOUT)
+            with registry.histogram("graph_request_seconds").time():
+                r = requests.get(url, params={**params, "access_token": token}, timeout=CONNECTION_TIMEOUT)
+            registry.counter("graph_requests_total", {"status": r.status_code}).inc()
+            code = None if r.status_code == 200 else error_code(r)
+            token_pool.report(token, r.status_code, code)
             if r.status_code == 200:
                 return r.json()
-            # handle Mapillary timeouts and transient errors
-            try:
-                err = r.json().get("error", {})
-            except Exception:
-                err = {}
-            if r.status_code in (429, 500, 502, 503, 504) or err.get("code") == -2:
+            # rate limited or Mapillary timeout: the pool has slowed this token down, the next
+            # attempt waits for it (or goes out with another token)
+            if is_throttled(r.status_code, code):
+                registry.counter("graph_throttled_total").inc()
+                continue
+            if is_invalid_token(r.status_code, code):
+                registry.counter("graph_invalid_token_total").inc()
+                continue
+            if r.status_code in (500, 502, 503, 504):
                 sleep_s = backoff * (attempt + 1)
-                print(f"HTTP {r.status_code} (code={err.get('code')}); retrying in {sleep_s:.1f}s …")
+                print(f"HTTP {r.status_code} (code={code}); retrying in {sleep_s:.1f}s …")
                 time.sleep(sleep_s)
                 continue
-            raise RuntimeError(f"HTTP {r.status_code}: {r.text[:400]}")
+            raise GraphAPIError(r.status_code, r.text)
         except requests.RequestException as e:
             if attempt == retries - 1:
                 raise
@@ -33,16 +60,10 @@ def safe_get(url, params, retries=RETRY_ATTEMPTS, backoff=RETRY_BACKOFF):
             print(f"Request error {e.__class__.__name__}; retrying in {sleep_s:.1f}s …")
             time.sleep(sleep_s)
 
-def get_image_info(image_id):
+def parse_image_info(data):
     """
-    Returns (lat, lon, url) for a Mapillary image id.
+    Returns (lat, lon, url) from a Graph API image answer.
     """
-    url = f"{BASE}/{image_id}"
-    params = {
-        "fields": "id,computed_geometry,thumb_1024_url",
-        "access_token": ACCESS_TOKEN,
-    }
-    data = safe_get(url, params)
     geom = (data or {}).get("computed_geometry", {})
     coords = geom.get("coordinates", [None, None])  # GeoJSON order: [lon, lat]
     lon, lat = (coords + [None, None])[:2]
@@ -50,7 +71,8 @@ def get_image_info(image_id):
     return lat, lon, photo_url
 
 def write_output(df: pd.DataFrame, path: str):
-    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
     if path.lower().endswith(".xlsx"):
         df.to_excel(path, index=False)
     else:
@@ -77,40 +99,75 @@ def get_metadata(image_names):
 
     print(f"{len(todo)} unique image IDs to fetch.")
 
-    rows = []
-    looked_up = 0
-    new_df_cols = ["image_id", "image_name", "lat", "lon", "url"]
+    # lookups finished by a previous (possibly interrupted) run are in the journal already
+    done_ids = {record["image_id"] for record in iter_records(JOURNAL_PATH)}
+    names = {img_id: fname for img_id, fname in todo if img_id not in done_ids}
+    if done_ids:
+        print(f"{len(todo) - len(names)} IDs already in {JOURNAL_PATH}; {len(names)} left to fetch.")
 
     # Optional: if SAVE_PATH exists, we overwrite — because you asked for only these images
     if os.path.exists(SAVE_PATH):
         print(f"NOTE: {SAVE_PATH} already exists and will be overwritten with ONLY these results.")
 
-    for img_id, fname in todo:
-        try:
-            lat, lon, url = get_image_info(img_id)
-            rows.append({
+    # several IDs per request, several requests in flight; results come back in completion order
+    # IDs resolved by a previous run are answered from the local cache
+    cache = MetadataCache(CACHE_PATH, ttls={"thumb_*_url": THUMB_URL_TTL})
+    looked_up = 0
+    reporter = Reporter(registry, REPORT_INTERVAL, rates=["lookups_total", "graph_requests_total"])
+    with Journal(JOURNAL_PATH) as journal, reporter:
+        for img_id, data in iter_image_data(safe_get, names, IMAGE_INFO_FIELDS,
+                                            batch_size=BATCH_SIZE, workers=FETCH_WORKERS, cache=cache):
+            if isinstance(data, Exception):
+                registry.counter("lookups_failed_total").inc()
+                print(f"Lookup failed for {img_id}: {data}")
+                continue
+            lat, lon, url = parse_image_info(data)
+            journal.append({
                 "image_id": img_id,
-                "image_name": fname,
+                "image_name": names[img_id],
                 "lat": lat,
                 "lon": lon,
-                "urltophoto": url
+                "url": url
             })
             looked_up += 1
+            registry.counter("lookups_total").inc()
 
-            # Periodic checkpoint to reduce risk of losing progress
+            # Periodic checkpoint: only the records appended since the last one are synced
             if looked_up % CHECKPOINT_EVERY == 0:
-                df_ckpt = pd.DataFrame(rows, columns=new_df_cols)
-                write_output(df_ckpt, SAVE_PATH)
-                print(f"[checkpoint] wrote {len(df_ckpt)} rows to: {SAVE_PATH}; processed {looked_up}/{len(todo)}")
-        except Exception as e:
-            print(f"Lookup failed for {img_id}: {e}")
-
-        time.sleep(SLEEP_BETWEEN_CALLS)
-
-    # Final write
-    df = pd.DataFrame(rows, columns=new_df_cols)
-    write_output(df, SAVE_PATH)
+                journal.flush()
+                print(f"[checkpoint] {JOURNAL_PATH}; processed {looked_up}/{len(names)}")
+
+    cache.close()
+    for i, rate in enumerate(token_pool.rates().values()):
+        registry.gauge("token_rate", {"token": i}).set(rate)
+    registry.write(METRICS_PATH)
+
+    # Final compaction: the journal rows for the requested IDs, last record per ID
+    if SAVE_PATH.lower().endswith(".parquet"):
+        # streamed from the journal to the partitions, never loaded as a whole
+        with ParquetExporter(SAVE_PATH, precision=GEOHASH_PRECISION, row_group_size=ROW_GROUP_SIZE) as exporter:
+            rows = exporter.write_all(iter_compacted(JOURNAL_PATH, dict(todo)))
+    else:
+        df = compact_journal(JOURNAL_PATH, dict(todo))
+        write_output(df, SAVE_PATH)
+        rows = len(df)
 
     print("Done.")
     abs_path = os.path.abspath(SAVE_PATH)
-    print(f"Saved {len(df)} rows to: {abs_path}")
\ No newline at end of file
+    print(f"Saved {rows} rows to: {abs_path}")
+
+
+def iter_compacted(path, wanted_ids):
+    """Yield the latest journal record of each ID in `wanted_ids`, in two passes so records are not kept in memory."""
+    last = {}  # ID -> position of its latest record
+    for position, record in enumerate(iter_records(path)):
+        if record.get("image_id") in wanted_ids:
+            last[record["image_id"]] = position
+    for position, record in enumerate(iter_records(path)):
+        if last.get(record.get("image_id")) == position:
+            yield record
+
+
+def compact_journal(path, wanted_ids):
+    """DataFrame of the latest journal record of each ID in `wanted_ids`."""
+    return pd.DataFrame(list(iter_compacted(path, wanted_ids)), columns=OUTPUT_COLUMNS)
@@ -1,21 +1,32 @@
 # ----------------------------------------------- LOCAL PATHS ----------------------------------------------------------
 DATASET_PATH = '../dataset.csv'
-SAVE_PATH = "MissedData20251027.xlsx"
+SAVE_PATH = "MissedData20251027.xlsx"  # .xlsx, .csv, or a .parquet directory partitioned by geohash
+CACHE_PATH = "metadata_cache.sqlite"
+METRICS_PATH = "MissedData20251027.metrics.json"  # final metrics; .json or Prometheus text (.prom)
+JOURNAL_PATH = "MissedData20251027.jsonl"  # lookups appended as they finish; SAVE_PATH is compacted from it
 # --------------------------------------------------- S3 ---------------------------------------------------------------
 BUCKET_NAME = 'image-model-dataset'
 # --------------------------------------------- MAPILLARY TOKENS -------------------------------------------------------
-# ACCESS_TOKEN = "MLY|24422725424056173|cdf5e992f6ac67e718d94388176e25a2"
-ACCESS_TOKEN = "MLY|31207836615529489|196c38079e3613763c4958b60e8e5c61"
-# ACCESS_TOKEN = "MLY|30953343454309714|c9bbb6e88980ca630a1b927d05e18731"
-# ACCESS_TOKEN = "MLY|24249135821381222|00a6922c8d44cf0ff4bebbb9915221e0"
-# ACCESS_TOKEN = "MLY|24422725424056173|cdf5e992f6ac67e718d94388176e25a2"
-# ACCESS_TOKEN = "MLY|24367282199588973|ab329daf5f6318861103b44332e3b200"
-# ACCESS_TOKEN = "MLY|24475726935382648|6a201517f3ec0c8293d2f84cb601ed31"
-# ACCESS_TOKEN = "MLY|24174695898870614|8d4851b44c79fccee6d44867c3ba94bb"
+# calls are spread over every token; tokens rejected by the API are dropped for the rest of the run
+ACCESS_TOKENS = [
+    "MLY|31207836615529489|196c38079e3613763c4958b60e8e5c61",
+    "MLY|24422725424056173|cdf5e992f6ac67e718d94388176e25a2",
+    "MLY|30953343454309714|c9bbb6e88980ca630a1b927d05e18731",
+    "MLY|24249135821381222|00a6922c8d44cf0ff4bebbb9915221e0",
+    "MLY|24367282199588973|ab329daf5f6318861103b44332e3b200",
+    "MLY|24475726935382648|6a201517f3ec0c8293d2f84cb601ed31",
+    "MLY|24174695898870614|8d4851b44c79fccee6d44867c3ba94bb",
+]
 # ---------------------------------------------- GENERAL VALUES --------------------------------------------------------
-SLEEP_BETWEEN_CALLS = 0.2
+RATE_PER_TOKEN = 5  # starting calls/s per token, adapted at runtime to 429 / code -2 answers
+MAX_RATE_PER_TOKEN = 100
 CONNECTION_TIMEOUT = 20
 RETRY_ATTEMPTS = 4
 RETRY_BACKOFF = 1.5
-CHECKPOINT_EVERY = 200
-BASE = "https://graph.mapillary.com"
\ No newline at end of file
+CHECKPOINT_EVERY = 200  # journal records between fsyncs
+REPORT_INTERVAL = 10  # seconds between two throughput reports, 0 to disable
+BATCH_SIZE = 50  # image IDs per Graph API request
+FETCH_WORKERS = 4  # Graph API requests in flight
+THUMB_URL_TTL = 3600  # seconds a cached signed thumbnail URL is reused
+GEOHASH_PRECISION = 4  # geohash characters of the .parquet partitions (4: cells of about 39 x 20 km)
+ROW_GROUP_SIZE = 100_000  # rows per Parquet row group
\ No newline at end of file
@@ -1,12 +1,50 @@
+import os
+import sqlite3
+import tempfile
+
 import pandas as pd
 from aws.S3 import S3
 from data_functions import get_metadata
 from global_conf import DATASET_PATH, BUCKET_NAME
 
-aws_files = S3().list_files(bucket_name=BUCKET_NAME)
-dataset = pd.read_csv(DATASET_PATH)
-local_files = dataset['filename'].tolist()
+CHUNK_ROWS = 100_000  # dataset rows read at once
+
+
+# yields the filenames of a CSV sorted and deduplicated, without holding them in memory: they are spilled to a
+# SQLite file in directory chunk by chunk and read back through its primary key, in binary (UTF-8) order like
+# the S3 listings
+def iter_sorted_names(path, directory, column='filename'):
+    db = sqlite3.connect(os.path.join(directory, 'names.sqlite'))
+    try:
+        db.execute("CREATE TABLE names (name TEXT PRIMARY KEY) WITHOUT ROWID")
+        for chunk in pd.read_csv(path, usecols=[column], chunksize=CHUNK_ROWS):
+            db.executemany("INSERT OR IGNORE INTO names VALUES (?)",
+                           ((name,) for name in chunk[column].dropna().astype(str)))
+        db.commit()
+        for (name,) in db.execute("SELECT name FROM names ORDER BY name"):
+            yield name
+    finally:
+        db.close()
+
+
+# symmetric difference of bucket keys and local filenames, both sorted, by a merge join: one item of each side
+# is held at a time, so memory follows the size of the difference, not of the bucket or of dataset.csv
+def symmetric_difference(keys, names):
+    keys, names = iter(keys), iter(names)
+    key, name = next(keys, None), next(names, None)
+    while key is not None or name is not None:
+        if name is None or (key is not None and key < name):
+            yield key
+            key = next(keys, None)
+        elif key is None or name < key:
+            yield name
+            name = next(names, None)
+        else:
+            key, name = next(keys, None), next(names, None)
+
 
-diff = list(set(aws_files) ^ set(local_files))
+with tempfile.TemporaryDirectory() as directory:
+    keys = S3().iter_files_parallel(bucket_name=BUCKET_NAME, ordered=True)
+    diff = list(symmetric_difference(keys, iter_sorted_names(DATASET_PATH, directory)))
 
 get_metadata(diff)
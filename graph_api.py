@@ -0,0 +1,146 @@
+"""
+Batched Mapillary Graph API lookups shared by mapillary_download.py and get_data.
+
+The Graph API accepts several comma-separated IDs in one `ids=` request and
+answers with an object keyed by ID. Both entry points keep their own HTTP
+function (session with urllib3 Retry, or safe_get); it is passed in as
+`get_json(url, params) -> dict`.
+"""
+import concurrent.futures
+import os
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+# overridable so that the benchmarks can point both entry points at a local stand-in
+BASE = os.environ.get("MAPILLARY_GRAPH_URL", "https://graph.mapillary.com")
+DEFAULT_BATCH_SIZE = 50
+# widths of the thumbnails served for every image, besides thumb_original_url
+THUMB_SIZES = (256, 1024, 2048)
+
+GetJson = Callable[[str, dict], Optional[dict]]
+Result = Union[dict, Exception]
+
+
+class GraphAPIError(RuntimeError):
+    """Non-retryable error answer from the Graph API."""
+
+    def __init__(self, status: int, text: str) -> None:
+        super().__init__(f"HTTP {status}: {text[:400]}")
+        self.status = status
+
+
+def http_status(error: Exception) -> Optional[int]:
+    """HTTP status carried by a GraphAPIError or a requests.HTTPError, if any."""
+    status = getattr(error, "status", None)
+    if status is None:
+        response = getattr(error, "response", None)
+        status = getattr(response, "status_code", None)
+    return status
+
+
+def thumb_field(resolution: Optional[int] = None) -> str:
+    """Field of the smallest thumbnail at least `resolution` px wide; the original without a resolution."""
+    for size in THUMB_SIZES:
+        if resolution is not None and size >= resolution:
+            return f"thumb_{size}_url"
+    return "thumb_original_url"
+
+
+def error_code(response) -> Optional[int]:
+    """Mapillary error code of an error answer (e.g. -2 for an API-side timeout), if any."""
+    try:
+        return response.json().get("error", {}).get("code")
+    except Exception:
+        return None
+
+
+def fetch_batch(get_json: GetJson, image_ids: List[str], fields: str, cache=None) -> Dict[str, Result]:
+    """
+    Look up several images with a single `ids=` request.
+
+    Returns a dict with an entry for every requested ID: the image data, or
+    the exception explaining why it is missing. When the API rejects the
+    whole request (e.g. one unknown ID makes it answer 400) the batch is
+    split in two until the offending IDs are isolated.
+
+    With a MetadataCache, fresh cached entries are answered without any
+    request and successful answers are written back to it.
+    """
+    if cache is None:
+        return _fetch_batch(get_json, image_ids, fields)
+
+    field_names = fields.split(",")
+    results: Dict[str, Result] = cache.get_many(image_ids, field_names)
+    missing = [image_id for image_id in image_ids if image_id not in results]
+    if missing:
+        fetched = _fetch_batch(get_json, missing, fields)
+        cache.put_many({k: v for k, v in fetched.items() if not isinstance(v, Exception)}, field_names)
+        results.update(fetched)
+    return results
+
+
+def _fetch_batch(get_json: GetJson, image_ids: List[str], fields: str) -> Dict[str, Result]:
+    if not image_ids:
+        return {}
+    try:
+        data = get_json(BASE, {"ids": ",".join(image_ids), "fields": fields}) or {}
+    except Exception as e:
+        if len(image_ids) == 1 or http_status(e) not in (400, 404):
+            return {image_id: e for image_id in image_ids}
+        middle = len(image_ids) // 2
+        results = _fetch_batch(get_json, image_ids[:middle], fields)
+        results.update(_fetch_batch(get_json, image_ids[middle:], fields))
+        return results
+
+    results = {}
+    for image_id in image_ids:
+        image_data = data.get(image_id)
+        if image_data is None:
+            results[image_id] = LookupError(f"image {image_id} missing from the batch answer")
+        else:
+            results[image_id] = image_data
+    return results
+
+
+def iter_sequence_image_ids(get_json: GetJson, sequence_id: str) -> Iterator[str]:
+    """Yield the image IDs of a sequence page by page, following the `paging.next` cursors."""
+    url, params = f"{BASE}/image_ids", {"sequence_id": sequence_id}
+    while url:
+        data = get_json(url, params) or {}
+        for image in data.get("data", []):
+            yield image["id"]
+        # the next URL already carries the query string and cursor
+        url, params = data.get("paging", {}).get("next"), {}
+
+
+def _batches(image_ids: Iterable[str], batch_size: int) -> Iterator[List[str]]:
+    batch = []
+    for image_id in image_ids:
+        batch.append(image_id)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_image_data(get_json: GetJson, image_ids: Iterable[str], fields: str,
+                    batch_size: int = DEFAULT_BATCH_SIZE, workers: int = 4,
+                    cache=None) -> Iterator[Tuple[str, Result]]:
+    """
+    Yield `(image_id, image data or exception)` for every ID, in completion order.
+
+    IDs are consumed lazily and at most `2 * workers` batches are in flight,
+    so this can be fed from a generator over millions of IDs. Running it over
+    a list of IDs with a cache and discarding the results prefetches them.
+    """
+    batches = _batches(image_ids, batch_size)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for batch in batches:
+            pending.add(executor.submit(fetch_batch, get_json, batch, fields, cache))
+            if len(pending) >= 2 * workers:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result().items()
+        for future in concurrent.futures.as_completed(pending):
+            yield from future.result().items()
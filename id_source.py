@@ -0,0 +1,74 @@
+"""
+Streaming image ID sources.
+
+IDs are read line by line from a CSV file, a plain text file (one ID per
+line) or stdin, so memory stays flat however long the file is and a limit
+stops the read early.
+"""
+import csv
+import itertools
+import sys
+from typing import Iterator, Optional, TextIO
+
+ID_COLUMNS = ("id", "image_id", "filename")
+
+
+def _looks_like_id(value: str) -> bool:
+    return value.strip().split(".")[0].isdigit()
+
+
+def _clean(value: str) -> str:
+    value = value.strip()
+    return value[:-4] if value.lower().endswith(".jpg") else value  # dataset.csv 'filename' is '<id>.jpg'
+
+
+def iter_csv_ids(lines: TextIO, column: Optional[str] = None) -> Iterator[str]:
+    """
+    Yield IDs from CSV lines. A header row is detected when its first cell
+    is not an ID; the column is then `column`, or the first of ID_COLUMNS
+    present, or the first one.
+    """
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if header is None:
+        return
+    index = 0
+    if column is not None or not _looks_like_id(header[0]):
+        names = [name.strip() for name in header]
+        wanted = [column] if column else [name for name in ID_COLUMNS if name in names]
+        if column and column not in names:
+            raise ValueError(f"Column {column!r} not in CSV header {names}")
+        index = names.index(wanted[0]) if wanted else 0
+    else:
+        reader = itertools.chain([header], reader)
+    for row in reader:
+        if len(row) > index and row[index].strip():
+            yield _clean(row[index])
+
+
+def iter_text_ids(lines: TextIO) -> Iterator[str]:
+    """Yield one ID per non-empty line, ignoring '#' comments and a header line."""
+    for i, line in enumerate(lines):
+        line = line.split("#", 1)[0].strip()
+        if line and (i or _looks_like_id(line)):
+            yield _clean(line)
+
+
+def iter_ids(path: str, column: Optional[str] = None, limit: Optional[int] = None) -> Iterator[str]:
+    """
+    Yield image IDs from `path` ('-' for stdin), stopping after `limit` IDs.
+    Files ending in .csv, or whose first line holds a comma, are read as CSV.
+    """
+    stream = sys.stdin if path == "-" else open(path, newline="", encoding="utf-8")
+    try:
+        first = stream.readline()
+        lines = itertools.chain([first], stream)
+        if path.lower().endswith(".csv") or "," in first or column:
+            ids = iter_csv_ids(lines, column)
+        else:
+            ids = iter_text_ids(lines)
+        yield from itertools.islice(ids, limit)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
@@ -0,0 +1,32 @@
+"""
+Downscaling and JPEG re-encoding of downloaded images with Pillow.
+
+Like tagging.tag_image, `resize_image` is CPU-bound and meant to run in a
+process pool: it takes and returns bytes. EXIF (and the ICC profile) are
+carried over to the re-encoded image.
+"""
+from io import BytesIO
+
+DEFAULT_JPEG_QUALITY = 90
+
+
+def resize_image(content, max_size, quality=DEFAULT_JPEG_QUALITY):
+    """
+    Return `content` scaled down so that its longest side is `max_size` px, re-encoded as JPEG.
+    Images already small enough are returned untouched, so they are not recompressed for nothing.
+    """
+    from PIL import Image
+
+    with Image.open(BytesIO(content)) as image:
+        if max(image.size) <= max_size:
+            return content
+        info = image.info
+        # JPEG decoding can scale by 1/2, 1/4 or 1/8 on the fly, much cheaper than decoding full size
+        image.draft('RGB', (max_size, max_size))
+        image.thumbnail((max_size, max_size), Image.LANCZOS)
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        out = BytesIO()
+        image.save(out, format='JPEG', quality=quality,
+                   exif=info.get('exif', b''), icc_profile=info.get('icc_profile'))
+        return out.getvalue()
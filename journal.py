@@ -0,0 +1,66 @@
+"""
+Append-only JSON Lines journal.
+
+Records are appended as work completes, so a checkpoint costs the same
+however many records were already written, and a crashed run can be
+resumed by reading the journal back. A line cut short by a crash is
+ignored on read.
+"""
+import json
+import os
+import threading
+from typing import Iterator
+
+
+class Journal:
+    def __init__(self, path: str, fsync: bool = True) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.file = open(path, "a", encoding="utf-8")
+        if self.file.tell() and not _ends_with_newline(path):
+            self.file.write("\n")  # close a line torn by a crash so the next record starts clean
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def append(self, record: dict) -> None:
+        line = json.dumps(record, separators=(",", ":"), ensure_ascii=False)
+        with self.lock:
+            self.file.write(line + "\n")
+
+    def flush(self) -> None:
+        """Make the records appended so far durable."""
+        with self.lock:
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+
+    def close(self) -> None:
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+
+def _ends_with_newline(path: str) -> bool:
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def iter_records(path: str) -> Iterator[dict]:
+    """Yield the records of a journal in write order; a missing journal is empty."""
+    if not os.path.exists(path):
+        return
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue  # torn write from a crash
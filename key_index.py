@@ -0,0 +1,118 @@
+"""
+Local index of the keys already present under an S3 bucket/prefix.
+
+The index lives in a SQLite file, so membership checks are B-tree lookups on
+disk and never need the bucket listing in memory. It is kept current in two
+ways:
+  - every key the downloader uploads is added as soon as the upload succeeds;
+  - `refresh` lists the bucket starting after the greatest key seen by the
+    previous listing (S3 lists keys in lexicographic order), so a rerun only
+    pages through keys added since.
+Keys written by someone else below that high-water mark, or objects deleted
+from the bucket, are only picked up by a full refresh (`full=True`).
+"""
+import sqlite3
+import threading
+import time
+from typing import Callable, Iterable, Optional, Set
+
+ListKeys = Callable[[str, Optional[str]], Iterable[str]]  # (prefix, start_after) -> keys
+
+_SQL_CHUNK = 500
+_WRITE_BATCH = 1000
+
+
+class KeyIndex:
+    def __init__(self, path: str, bucket_name: str, prefix: str = '') -> None:
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.pending = []
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS s3_keys ("
+            " bucket TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (bucket, key)) WITHOUT ROWID"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS s3_listings ("
+            " bucket TEXT NOT NULL, prefix TEXT NOT NULL, last_key TEXT, listed_at REAL NOT NULL,"
+            " PRIMARY KEY (bucket, prefix))"
+        )
+        self.db.commit()
+
+    def close(self) -> None:
+        self.flush()
+        with self.lock:
+            self.db.close()
+
+    def last_listing(self):
+        """(last_key, listed_at) of the previous listing of this bucket/prefix, or None."""
+        with self.lock:
+            return self.db.execute(
+                "SELECT last_key, listed_at FROM s3_listings WHERE bucket = ? AND prefix = ?",
+                (self.bucket_name, self.prefix),
+            ).fetchone()
+
+    def refresh(self, list_keys: ListKeys, full: bool = False) -> int:
+        """
+        Bring the index up to date with the bucket and return how many keys were listed.
+
+        Without a previous listing, or with `full=True`, the whole prefix is
+        listed and replaces what the index knew about it.
+        """
+        previous = None if full else self.last_listing()
+        start_after = previous[0] if previous else None
+        started = time.time()
+        listed = 0
+        last_key = start_after
+        batch = []
+        with self.lock:
+            if previous is None:
+                self.db.execute("DELETE FROM s3_keys WHERE bucket = ? AND substr(key, 1, ?) = ?",
+                                (self.bucket_name, len(self.prefix), self.prefix))
+            for key in list_keys(self.prefix, start_after):
+                batch.append((self.bucket_name, key))
+                listed += 1
+                last_key = key if last_key is None or key > last_key else last_key
+                if len(batch) >= _WRITE_BATCH:
+                    self.db.executemany("INSERT OR IGNORE INTO s3_keys VALUES (?, ?)", batch)
+                    batch = []
+            self.db.executemany("INSERT OR IGNORE INTO s3_keys VALUES (?, ?)", batch)
+            self.db.execute("INSERT OR REPLACE INTO s3_listings VALUES (?, ?, ?, ?)",
+                            (self.bucket_name, self.prefix, last_key, started))
+            self.db.commit()
+        return listed
+
+    def existing(self, keys: Iterable[str]) -> Set[str]:
+        """The subset of `keys` known to exist in the bucket."""
+        keys = list(keys)
+        found = set()
+        with self.lock:
+            for start in range(0, len(keys), _SQL_CHUNK):
+                chunk = keys[start:start + _SQL_CHUNK]
+                rows = self.db.execute(
+                    f"SELECT key FROM s3_keys WHERE bucket = ? AND key IN ({','.join('?' * len(chunk))})",
+                    [self.bucket_name] + chunk,
+                )
+                found.update(key for (key,) in rows)
+        return found
+
+    def __contains__(self, key: str) -> bool:
+        return bool(self.existing([key]))
+
+    def add(self, key: str) -> None:
+        """Record a key that was just uploaded; writes are batched, see `flush`."""
+        with self.lock:
+            self.pending.append((self.bucket_name, key))
+            if len(self.pending) < _WRITE_BATCH:
+                return
+        self.flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            if self.pending:
+                self.db.executemany("INSERT OR IGNORE INTO s3_keys VALUES (?, ?)", self.pending)
+                self.db.commit()
+                self.pending = []
@@ -1,15 +1,44 @@
 import argparse
 import concurrent.futures
+import itertools
+import multiprocessing
 import os
 import sys
+import threading
+import time
+import uuid
 from io import BytesIO
 
-import boto3
-import pandas as pd
 import requests
 from requests.adapters import HTTPAdapter, Retry
 
-s3_client = boto3.client('s3')
+from failures import DEFAULT_MAX_ATTEMPTS, GIVE_UP, REFRESH, RETRY, FailureLog, MissingThumbnail
+from graph_api import (BASE, DEFAULT_BATCH_SIZE, THUMB_SIZES, GraphAPIError, error_code, fetch_batch,
+                       iter_sequence_image_ids, thumb_field)
+from id_source import iter_ids
+from imaging import DEFAULT_JPEG_QUALITY, resize_image
+from key_index import KeyIndex
+from metadata_cache import THUMB_URL_TTL, MetadataCache
+from metrics import Reporter, registry
+from pipeline import Pipeline, Stage
+from progress import (DEFAULT_LEASE_SECONDS, Heartbeat, ProgressStore, in_shard, parse_shard, shard_of,
+                      shard_order, until_set)
+from rate_limit import TokenPool, is_invalid_token, is_throttled
+from sinks import (DEFAULT_SHARD_COUNT, DEFAULT_SHARD_SIZE, LocalDirectorySink, S3ObjectSink, TarShardSink,
+                   local_opener, metadata_record, object_key, s3_opener)
+from sync import SyncState, bbox_scope, iso_time, sequence_scope
+from tagging import TAG_FIELDS, tag_fields, tag_image
+from thinning import THIN_FIELDS, Thinner
+from tiles import DEFAULT_TILE_SIZE, iter_bbox_image_ids, parse_bbox
+from transfer import DEFAULT_CHUNK_SIZE, DEFAULT_PART_SIZE, MIN_PART_SIZE, MiB, stream_to_s3
+
+IMAGE_FIELDS = 'captured_at,sequence'  # besides the thumbnail URL, see image_fields
+
+DEFAULT_IDS_FILE = 'dataset.csv'
+
+s3_client = None  # created on first use, importing boto3 is slow
+s3_client_lock = threading.Lock()
+s3_pool_size = 10
 
 session = requests.Session()
 retries_strategies = Retry(
@@ -17,98 +46,686 @@ retries_strategies = Retry(
     backoff_factor=1,
     status_forcelist=[429, 502, 503, 504],
 )
+# 429 from the Graph API is not retried by urllib3 but handed to the token pool, which slows down
+graph_retries_strategies = Retry(
+    total=5,
+    backoff_factor=1,
+    status_forcelist=[502, 503, 504],
+)
 session.mount('https://', HTTPAdapter(max_retries=retries_strategies))
+session.mount(BASE, HTTPAdapter(max_retries=graph_retries_strategies))
+
+token_pool = None
 
 
 def parse_args(argv=None):
     parser = argparse.ArgumentParser()
 
-    df = pd.read_csv('dataset.csv')
-
-
-    parser.add_argument('access_token', type=str, help='Your Mapillary access token')
+    parser.add_argument('access_token', type=str, nargs='+',
+                        help='Your Mapillary access token(s); calls are spread across all of them')
     parser.add_argument(
         '--destination',type=str,default='image-model-dataset',
         help='S3 bucket name (optionally with a path prefix, e.g. my-bucket/images)')
     parser.add_argument('--sequence_ids', nargs='*', help='Sequence IDs to download')
-    parser.add_argument('--image_ids',nargs='*',default=df['id'].astype(str).tolist(),
-                        help='Mapillary image IDs to process')
-    parser.add_argument('--image_limit', type=int, default=None, help='Max images to download')
-    parser.add_argument('--overwrite', action='store_true', help='Overwrite existing files if they exist')
+    parser.add_argument('--image_ids',nargs='*', help='Mapillary image IDs to process')
+    parser.add_argument('--ids_file', type=str, default=None,
+                        help=f'CSV or text file of image IDs, "-" for stdin, read as a stream '
+                             f'(default: {DEFAULT_IDS_FILE} when no IDs are given)')
+    parser.add_argument('--ids_column', type=str, default=None,
+                        help='CSV column holding the IDs (default: id, image_id or filename)')
+    parser.add_argument('--bbox', type=str, default=None,
+                        help='Download the images in this bounding box, given as west,south,east,north in degrees')
+    parser.add_argument('--tile_size', type=float, default=DEFAULT_TILE_SIZE,
+                        help='Size in degrees of the tiles the --bbox is searched in; full tiles are split further')
+    parser.add_argument('--bbox_workers', type=int, default=8, help='Tiles of the --bbox searched concurrently')
+    parser.add_argument('--image_limit', type=int, default=None,
+                        help='Max images to download (per work shard with --shard)')
+    parser.add_argument('--shard', type=str, default=None,
+                        help='i/N: download the work shard i of N (IDs split by a stable hash), then take over the '
+                             'other shards as their leases expire, until all are completed')
+    parser.add_argument('--progress', type=str, default='progress.sqlite',
+                        help='SQLite file shared by the --shard nodes: leases of the work shards and stored image IDs')
+    parser.add_argument('--lease_seconds', type=float, default=DEFAULT_LEASE_SECONDS,
+                        help='Seconds without heartbeat after which a work shard can be taken over by another node')
+    parser.add_argument('--sync', action='store_true',
+                        help='Only fetch what is new in the --sequence_ids and --bbox since the previous --sync run, '
+                             'using the capture time watermarks and seen IDs kept in --sync_state')
+    parser.add_argument('--sync_state', type=str, default='sync_state.sqlite',
+                        help='SQLite file of the --sync watermarks')
+    parser.add_argument('--thin_distance', type=float, default=None,
+                        help='Skip, before downloading it, an image within this many meters of an image already kept '
+                             '(from any sequence)')
+    parser.add_argument('--thin_heading', type=float, default=None,
+                        help='With --thin_distance, only skip the images looking within this many degrees of the '
+                             'nearby kept image (default: whatever their heading)')
+    parser.add_argument('--sink', choices=['s3', 'local', 'tar'], default='s3',
+                        help='s3: one object per image in --destination; local: one file per image in --output_dir; '
+                             'tar: tar shards of images and their metadata JSON, in --output_dir if given, '
+                             'else in --destination, named after the run so reruns never overwrite them '
+                             '(local and tar imply --buffered)')
+    parser.add_argument('--output_dir', type=str, default=None, help='Local directory of the local and tar sinks')
+    parser.add_argument('--shard_count', type=int, default=DEFAULT_SHARD_COUNT, help='Max images per tar shard')
+    parser.add_argument('--shard_size', type=int, default=DEFAULT_SHARD_SIZE // MiB,
+                        help='Max size in MiB of a tar shard')
+    parser.add_argument('--shard_writers', type=int, default=4,
+                        help='Tar shards written at the same time')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Overwrite existing files if they exist (always the case with the local and tar sinks)')
+    parser.add_argument('--key_index', type=str, default='key_index.sqlite',
+                        help='SQLite file indexing the keys already in the destination bucket')
+    parser.add_argument('--refresh_index', action='store_true',
+                        help='List the whole destination again instead of only the keys added since the last run')
+    parser.add_argument('--sequence_workers', type=int, default=8,
+                        help='Sequences whose image IDs are listed concurrently')
+    parser.add_argument('--metadata_workers', type=int, default=8,
+                        help='Concurrent Graph API metadata requests')
+    parser.add_argument('--metadata_batch_size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='Image IDs looked up per Graph API request')
+    parser.add_argument('--cache', type=str, default='metadata_cache.sqlite',
+                        help='SQLite file caching image metadata between runs')
+    parser.add_argument('--no_cache', action='store_true', help='Always ask the Graph API, ignore the metadata cache')
+    parser.add_argument('--thumb_url_ttl', type=int, default=THUMB_URL_TTL,
+                        help='Seconds a cached (signed) thumbnail URL is reused before being fetched again')
+    parser.add_argument('--download_workers', type=int, default=16, help='Concurrent image downloads')
+    parser.add_argument('--upload_workers', type=int, default=16, help='Concurrent S3 uploads (--buffered only)')
+    parser.add_argument('--chunk_size', type=int, default=DEFAULT_CHUNK_SIZE // 1024,
+                        help='Size in KiB of the chunks read from the image CDN')
+    parser.add_argument('--part_size', type=int, default=DEFAULT_PART_SIZE // MiB,
+                        help='Size in MiB of the S3 multipart upload parts (min 5)')
+    parser.add_argument('--buffered', action='store_true',
+                        help='Download each image fully in memory before uploading it instead of streaming it')
+    parser.add_argument('--geotag', action='store_true',
+                        help='Write GPS position, direction, capture time and projection in the images (implies --buffered)')
+    parser.add_argument('--tag_workers', type=int, default=os.cpu_count(),
+                        help='Processes writing the image metadata and resizing the images')
+    parser.add_argument('--resolution', type=int, default=None,
+                        help=f'Target width in px: download the smallest thumbnail ({", ".join(map(str, THUMB_SIZES))} '
+                             f'or original) at least this wide (default: original)')
+    parser.add_argument('--resize', action='store_true',
+                        help='Scale images down to --resolution px on their longest side and re-encode them as JPEG, '
+                             'keeping their EXIF (implies --buffered)')
+    parser.add_argument('--jpeg_quality', type=int, default=DEFAULT_JPEG_QUALITY,
+                        help='JPEG quality of the images re-encoded by --resize')
+    parser.add_argument('--rate', type=float, default=5,
+                        help='Starting Graph API calls/s per access token, adapted to throttling answers')
+    parser.add_argument('--max_rate', type=float, default=100, help='Max Graph API calls/s per access token')
+    parser.add_argument('--queue_size', type=int, default=256,
+                        help='Max images waiting between two pipeline stages')
+    parser.add_argument('--failures', type=str, default='failures.jsonl',
+                        help='JSON Lines journal of the images and sequences that failed, with stage, error and HTTP status')
+    parser.add_argument('--retry_failed', action='store_true',
+                        help='Only process the failures still open in --failures (instead of the given IDs), '
+                             'refreshing the thumbnail URLs that expired')
+    parser.add_argument('--max_attempts', type=int, default=DEFAULT_MAX_ATTEMPTS,
+                        help='Failures after which --retry_failed gives up on an image')
+    parser.add_argument('--report_interval', type=float, default=10,
+                        help='Seconds between two live throughput reports (0 to disable)')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='Write the final metrics to this file: JSON if it ends in .json, '
+                             'Prometheus text format otherwise')
     parser.add_argument('-v', '--version', action='version', version='release 2.0')
 
     args = parser.parse_args(argv)
 
-    if args.sequence_ids is None and args.image_ids is None:
-        parser.error("Please provide at least one sequence_id or image_id")
+    if args.shard is not None:
+        try:
+            args.shard = parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.thin_heading is not None and args.thin_distance is None:
+        parser.error("--thin_heading needs a --thin_distance")
+    if args.sync and args.shard is not None:
+        parser.error("--sync cannot be combined with --shard")
+    if args.bbox is not None:
+        try:
+            args.bbox = parse_bbox(args.bbox)
+        except ValueError as e:
+            parser.error(str(e))
+    args.tiles = None  # bbox tiles whose search failed, retried with --retry_failed
+    if args.retry_failed:
+        args.sequence_ids = args.image_ids = args.ids_file = args.bbox = None  # the IDs come from --failures
+    elif args.sequence_ids is None and args.image_ids is None and args.ids_file is None and args.bbox is None:
+        if not os.path.exists(DEFAULT_IDS_FILE):
+            parser.error("Please provide at least one sequence_id, image_id or a bbox")
+        args.ids_file = DEFAULT_IDS_FILE
+    if args.part_size * MiB < MIN_PART_SIZE:
+        parser.error("--part_size must be at least 5 MiB")
+    if args.resize and args.resolution is None:
+        parser.error("--resize needs a --resolution")
+    if args.sink == 'local' and args.output_dir is None:
+        parser.error("--sink local needs an --output_dir")
+    if args.geotag or args.resize or args.sink != 's3':
+        args.buffered = True
 
     return args
 
 
-def download(url, bucket_name, key_name):
-    try:
-        r = session.get(url, stream=True, timeout=10)
+def configure_session(pool_size):
+    """Size the connection pools so that every pipeline worker gets its own connection."""
+    global s3_pool_size
+    s3_pool_size = pool_size
+    adapter = HTTPAdapter(max_retries=retries_strategies, pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.mount(BASE, HTTPAdapter(max_retries=graph_retries_strategies,
+                                    pool_connections=pool_size, pool_maxsize=pool_size))
+
+
+def configure_tokens(access_tokens, rate, max_rate):
+    global token_pool
+    token_pool = TokenPool(access_tokens, rate=rate, max_rate=max_rate)
+
+
+def get_s3_client():
+    global s3_client
+    with s3_client_lock:
+        if s3_client is None:
+            import boto3
+            from botocore.config import Config
+
+            s3_client = boto3.client('s3', config=Config(max_pool_connections=s3_pool_size))
+    return s3_client
+
+
+def download(url):
+    with registry.histogram('download_seconds').time():
+        r = session.get(url, timeout=10)
         r.raise_for_status()
+    registry.counter('downloaded_bytes_total').inc(len(r.content))
+    return r.content
 
-        s3_client.upload_fileobj(BytesIO(r.content), bucket_name, key_name)
-        print(f"✅ Uploaded to s3://{bucket_name}/{key_name}")
 
-    except Exception as e:
-        print(f"⚠️ Failed to upload {url} to S3: {e}")
+def upload(content, bucket_name, key_name):
+    get_s3_client().upload_fileobj(BytesIO(content), bucket_name, key_name)
 
 
-def get_single_image_data(image_id, header):
-    req_url = (
-        f'https://graph.mapillary.com/{image_id}?fields='
-        'thumb_original_url,captured_at,sequence'
-    )
-    try:
-        r = session.get(req_url, headers=header, timeout=10)
+def parse_destination(destination):
+    """Split 'bucket/some/prefix' into ('bucket', 'some/prefix/')."""
+    bucket_name, _, prefix = destination.strip('/').partition('/')
+    return bucket_name, f"{prefix}/" if prefix else ''
+
+
+def transfer(url, bucket_name, key_name, chunk_size=DEFAULT_CHUNK_SIZE, part_size=DEFAULT_PART_SIZE):
+    """Pipe an image from the CDN into S3 without holding more than one part in memory."""
+    with registry.histogram('transfer_seconds').time(), session.get(url, stream=True, timeout=10) as r:
+        r.raise_for_status()
+        size = stream_to_s3(get_s3_client(), r.iter_content(chunk_size), bucket_name, key_name, part_size=part_size)
+    registry.counter('uploaded_bytes_total').inc(size)
+    registry.counter('images_uploaded_total').inc()
+    return size
+
+
+def graph_get(url, params, attempts=5):
+    """GET on the Graph API with a token from the pool; throttled calls are retried when the pool allows."""
+    for attempt in range(attempts):
+        if attempt:
+            registry.counter('graph_retries_total').inc()
+        token = token_pool.acquire()
+        with registry.histogram('graph_request_seconds').time():
+            r = session.get(url, params=params, headers={'Authorization': f'OAuth {token}'}, timeout=10)
+        registry.counter('graph_requests_total', {'status': r.status_code}).inc()
+        code = None if r.ok else error_code(r)
+        token_pool.report(token, r.status_code, code)
+        if is_throttled(r.status_code, code):
+            registry.counter('graph_throttled_total').inc()
+            continue
+        if is_invalid_token(r.status_code, code):
+            registry.counter('graph_invalid_token_total').inc()
+            continue
         r.raise_for_status()
         return r.json()
-    except Exception as e:
-        print(f"⚠️ Error fetching image {image_id}: {e}")
-        return None
+    raise GraphAPIError(r.status_code, r.text)
 
 
-if __name__ == '__main__':
-    args = parse_args()
-    os.makedirs(args.destination, exist_ok=True)
+def image_fields(url_field, geotag=False, thin=False):
+    fields = ','.join([url_field, IMAGE_FIELDS] + ([TAG_FIELDS] if geotag else [])
+                      + ([THIN_FIELDS] if thin else [])).split(',')
+    return ','.join(dict.fromkeys(fields))
 
-    access_token = args.access_token
-    header = {'Authorization': f'OAuth {access_token}'}
 
-    # gather image IDs
-    image_ids = args.image_ids or []
-    if args.sequence_ids:
-        for seq in args.sequence_ids:
-            url = f'https://graph.mapillary.com/image_ids?sequence_id={seq}'
-            r = session.get(url, headers=header)
-            data = r.json()
-            image_ids.extend([x['id'] for x in data.get('data', [])])
+def failure_recorder(failures):
+    """Pipeline on_error hook writing the IDs of the failed item to the failure journal."""
+
+    def on_error(stage, item, error):
+        if isinstance(item, SequenceId):
+            item_ids, kind = [item], 'sequence'
+        else:
+            items = item if isinstance(item, list) else [item]  # a batch
+            item_ids, kind = [entry['id'] if isinstance(entry, dict) else entry for entry in items], 'image'
+        more = f" and {len(item_ids) - 3} more" if len(item_ids) > 3 else ''
+        print(f"⚠️ {stage.name} failed for {', '.join(map(str, item_ids[:3]))}{more}: {error}")
+        for item_id in item_ids:
+            failures.record(item_id, stage.name, error, kind)
+
+    return on_error
+
+
+class SequenceId(str):
+    """A sequence ID waiting in the pipeline to be expanded into its image IDs."""
+
+
+class Limit:
+    """Thread-safe countdown shared by the workers of a stage."""
+
+    def __init__(self, limit=None):
+        self.remaining = limit
+        self.lock = threading.Lock()
+
+    def take(self):
+        if self.remaining is None:
+            return True
+        with self.lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+    @property
+    def exhausted(self):
+        return self.remaining is not None and self.remaining <= 0
+
+
+def resolve_image_ids(args, shard=None, sync=None, failures=None):
+    """
+    Pipeline input: the requested sequences first (their listing is the slow part), then the image IDs,
+    then the images found in the bounding box (with a SyncState, only those captured since its watermark
+    and not seen yet) and in the tiles retried. Image IDs of other work shards are dropped.
+    Without sequences, --image_limit is applied here so the ID list is not read past it.
+    """
+    sequences = (SequenceId(seq) for seq in args.sequence_ids or [])
+    image_ids = iter(args.image_ids or [])
+    if args.ids_file:
+        image_ids = itertools.chain(image_ids, iter_ids(args.ids_file, args.ids_column))
+
+    def bbox_ids(bbox, params=None, scope=None):
+        """The images of a box; a tile whose search failed goes to the failure journal, and keeps the scope's watermark."""
+        failed = []
 
-    if not image_ids:
-        print("No images found.")
-        sys.exit()
+        def on_error(tile, error):
+            failed.append(tile)
+            print(f"⚠️ Search of tile {tile.bbox} failed, its images are missed: {error}")
+            if failures is not None:
+                failures.record(tile.bbox, 'bbox', error, kind='tile')
+            if scope is not None:
+                sync.missed(scope)
 
-    print(f"Starting downloads for {len(image_ids)} images...")
+        # tiles are searched concurrently in the background while the pipeline pulls the IDs
+        yield from iter_bbox_image_ids(graph_get, bbox, tile_size=args.tile_size, workers=args.bbox_workers,
+                                       params=params, on_error=on_error)
+        if not failed and failures is not None:
+            failures.resolve(','.join(map(str, bbox)))  # a retried tile
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=6) as executor:
-        for i, image_id in enumerate(image_ids):
-            if args.image_limit is not None and i >= args.image_limit:
-                break
+    if args.bbox:
+        params, scope = None, None
+        if sync is not None:
+            scope = bbox_scope(args.bbox)
+            watermark = sync.watermark(scope)
+            params = {'start_captured_at': iso_time(watermark)} if watermark is not None else None
+        ids = bbox_ids(args.bbox, params, scope)
+        if sync is not None:
+            ids = sync.track(scope, ids)
+        image_ids = itertools.chain(image_ids, ids)
+    for tile in args.tiles or []:
+        image_ids = itertools.chain(image_ids, bbox_ids(parse_bbox(tile)))
+    if shard is not None:
+        image_ids = (image_id for image_id in image_ids if in_shard(image_id, shard))
+    if not args.sequence_ids:
+        image_ids = itertools.islice(image_ids, args.image_limit)
+    return itertools.chain(sequences, image_ids)
 
-            image_data = get_single_image_data(image_id, header)
-            if not image_data or 'thumb_original_url' not in image_data:
+
+def build_sink(args, bucket_name, prefix='', progress=None, sync=None, failures=None):
+    if args.sink == 'local':
+        return LocalDirectorySink(args.output_dir)
+    if args.sink == 'tar':
+        if args.output_dir:
+            opener = local_opener(args.output_dir)
+        else:
+            opener = s3_opener(get_s3_client(), bucket_name, prefix, part_size=args.part_size * MiB)
+        # every run (and every node) adds its own shards next to the previous ones, never over them
+        run_name = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        if progress is not None:
+            run_name = f"{args.shard[0]}of{args.shard[1]}-{run_name}"
+        name = f"shard-{run_name}"
+
+        def on_commit(image_ids):
+            for image_id in image_ids:
+                if progress is not None:
+                    progress.add(image_id, (shard_of(image_id, args.shard[1]), args.shard[1]))
+                if sync is not None:
+                    sync.stored(image_id)
+                if failures is not None:
+                    failures.resolve(image_id)
+
+        def on_drop(image_ids, error):
+            # counted as uploaded when written to the shard, lost with it: they are failures to retry
+            registry.counter('images_uploaded_total').inc(-len(image_ids))
+            if failures is not None:
+                for image_id in image_ids:
+                    failures.record(image_id, 'upload', error)
+        return TarShardSink(opener, writers=args.shard_writers, max_count=args.shard_count,
+                            max_size=args.shard_size * MiB, name=name, manifest=f"{name}.json", on_commit=on_commit,
+                            on_drop=on_drop)
+    return S3ObjectSink(upload, bucket_name, prefix)
+
+
+def build_stages(args, bucket_name, prefix='', cache=None, key_index=None, process_pool=None, sink=None,
+                 shard=None, progress=None, sync=None, failures=None):
+    limit = Limit(args.image_limit)
+    url_field = thumb_field(args.resolution)
+    fields = image_fields(url_field, args.geotag, thin=args.thin_distance is not None)
+    thinner = Thinner(args.thin_distance, args.thin_heading) if args.thin_distance is not None else None
+
+    def expand_sequences(item):
+        """Stream the image IDs of a sequence as its pages arrive; plain image IDs pass through."""
+        if isinstance(item, SequenceId):
+            if limit.exhausted:
+                return  # do not list the sequences left once the limit is reached
+            image_ids = iter_sequence_image_ids(graph_get, item)
+            if sync is not None:
+                image_ids = sync.track(sequence_scope(item), image_ids)
+        else:
+            image_ids = [item]
+        for image_id in image_ids:
+            if not in_shard(image_id, shard):
                 continue
+            if not limit.take():
+                return
+            yield image_id
+
+    def skipped(image_id):
+        if sync is not None:
+            sync.stored(image_id)
+        if failures is not None:
+            failures.resolve(image_id)
+
+    def skip_existing(image_ids):
+        existing = key_index.existing(object_key(prefix, image_id) for image_id in image_ids)
+        for image_id in image_ids:
+            if object_key(prefix, image_id) in existing:
+                skipped(image_id)
+        return [image_id for image_id in image_ids if object_key(prefix, image_id) not in existing]
+
+    def skip_done(image_ids):
+        done = progress.done(image_ids)
+        return [image_id for image_id in image_ids if image_id not in done]
+
+    def uploaded(image_id, key_name):
+        if key_index is not None:
+            key_index.add(key_name)
+        if isinstance(sink, TarShardSink):
+            return  # images in a tar shard are recorded when the shard is finished, see build_sink
+        if progress is not None:
+            progress.add(image_id, shard)
+        if sync is not None:
+            sync.stored(image_id)
+        if failures is not None:
+            failures.resolve(image_id)
 
-            bucket_name = "image-model-dataset"  # <-- Change this
-            key_name = f"{image_data['id']}.jpg"  # The filename inside S3
+    def fetch_metadata(image_ids):
+        with registry.histogram('metadata_fetch_seconds').time():
+            batch = fetch_batch(graph_get, image_ids, fields, cache)
+        for image_id, image_data in batch.items():
+            if not isinstance(image_data, Exception) and url_field not in image_data:
+                image_data = MissingThumbnail(f"no {url_field} in the answer")
+            if isinstance(image_data, Exception):
+                registry.counter('metadata_failed_total').inc()
+                print(f"⚠️ Error fetching image {image_id}: {image_data}")
+                if failures is not None:
+                    failures.record(image_id, 'metadata', image_data)
+                continue
+            image_data.setdefault('id', image_id)
+            if sync is not None:
+                sync.note(image_id, image_data.get('captured_at'))
+            yield image_data
+
+    def thin(image_data):
+        if thinner.accept(image_data):
+            yield image_data
+        else:
+            registry.counter('thinned_total').inc()
+            skipped(image_data['id'])
+
+    def stream(image_data):
+        key_name = object_key(prefix, image_data['id'])
+        transfer(image_data[url_field], bucket_name, key_name,
+                 chunk_size=args.chunk_size * 1024, part_size=args.part_size * MiB)
+        uploaded(image_data['id'], key_name)
+        return image_data
+
+    def fetch_bytes(image_data):
+        image_data['content'] = download(image_data[url_field])
+        return image_data
+
+    def resize(image_data):
+        # Pillow releases the GIL only in parts of the work, a process scales much better
+        size = len(image_data['content'])
+        with registry.histogram('resize_seconds').time():
+            image_data['content'] = process_pool.submit(resize_image, image_data['content'], args.resolution,
+                                                        args.jpeg_quality).result()
+        registry.counter('resize_input_bytes_total').inc(size)
+        registry.counter('resize_output_bytes_total').inc(len(image_data['content']))
+        return image_data
+
+    def tag(image_data):
+        # pyexiv2 holds the GIL, so the work goes to a process; this thread only waits for it
+        with registry.histogram('tag_seconds').time():
+            image_data['content'] = process_pool.submit(tag_image, image_data['content'], tag_fields(image_data)).result()
+        return image_data
+
+    def store(image_data):
+        content = image_data.pop('content')
+        with registry.histogram('upload_seconds').time():
+            location = sink.write(image_data['id'], content, metadata_record(image_data))
+        registry.counter('uploaded_bytes_total').inc(len(content))
+        registry.counter('images_uploaded_total').inc()
+        uploaded(image_data['id'], location)
+        return image_data
+
+    stages = []
+    if args.sequence_ids:
+        stages.append(Stage('sequences', expand_sequences, workers=args.sequence_workers, fan_out=True))
+    if key_index is not None:
+        # drop IDs already in the bucket before spending a metadata request on them
+        stages.append(Stage('skip_existing', skip_existing, workers=1, batch_size=500))
+    if progress is not None:
+        # drop IDs another node (or an earlier run) already stored
+        stages.append(Stage('skip_done', skip_done, workers=1, batch_size=500))
+    stages += [Stage('metadata', fetch_metadata, workers=args.metadata_workers, batch_size=args.metadata_batch_size)]
+    if thinner is not None:
+        # cheap, and in a single worker the images are kept in the order they come
+        stages.append(Stage('thin', thin, workers=1, fan_out=True))
+    if args.buffered:
+        stages.append(Stage('download', fetch_bytes, workers=args.download_workers))
+        if args.resize:
+            stages.append(Stage('resize', resize, workers=args.tag_workers))
+        if args.geotag:
+            stages.append(Stage('tag', tag, workers=args.tag_workers))
+        stages.append(Stage('upload', store, workers=args.upload_workers))
+    else:
+        stages.append(Stage('transfer', stream, workers=args.download_workers))
+    return stages
 
-            # if not args.overwrite and os.path.exists(filepath):
-            #     print(f"Skipping existing {filepath}")
-            #     continue
 
-            executor.submit(download, image_data['thumb_original_url'], bucket_name, key_name)
+def peek(iterator):
+    """The iterator unchanged, or None if it is empty."""
+    first = next(iterator, None)
+    return None if first is None else itertools.chain([first], iterator)
 
-    print("✅ All downloads complete!")
+
+def main(argv=None):
+    args = parse_args(argv)
+    registry.reset()  # the summary and --metrics cover this run only, not an earlier main() of the process
+
+    configure_tokens(args.access_token, args.rate, args.max_rate)
+    configure_session(args.metadata_workers + args.download_workers)
+
+    failures = FailureLog(args.failures)
+    refresh_ids = []
+    if args.retry_failed:
+        plan = failures.plan(args.max_attempts)
+        retried = plan[RETRY] + plan[REFRESH]
+        refresh_ids = [record['id'] for record in plan[REFRESH]]
+        print(f"Retrying {len(retried)} failures ({len(refresh_ids)} with a fresh thumbnail URL), "
+              f"giving up on {len(plan[GIVE_UP])}")
+        args.sequence_ids = [record['id'] for record in retried if record.get('kind') == 'sequence'] or None
+        args.tiles = [record['id'] for record in retried if record.get('kind') == 'tile']
+        args.image_ids = [record['id'] for record in retried if record.get('kind') not in ('sequence', 'tile')]
+
+    sync = SyncState(args.sync_state) if args.sync else None
+    if args.shard is None:
+        image_ids = peek(resolve_image_ids(args, sync=sync, failures=failures))
+        if image_ids is None:
+            if sync is not None:
+                sync.commit()  # the listings were read to the end: records when this scope was last synced
+                sync.close()
+            print("No failures to retry." if args.retry_failed else
+                  "No new images found." if sync is not None else "No images found.")
+            failures.close()
+            sys.exit()
+
+    bucket_name, prefix = parse_destination(args.destination)
+
+    key_index = None
+    if not args.overwrite and args.sink == 's3':
+        from get_data.aws.S3 import S3
+
+        key_index = KeyIndex(args.key_index, bucket_name, prefix)
+        # the index keeps the greatest key listed, so the key ranges can be listed concurrently
+        listed = key_index.refresh(lambda p, start_after: S3().iter_files_parallel(bucket_name, p, start_after),
+                                   full=args.refresh_index)
+        print(f"Key index of s3://{bucket_name}/{prefix} refreshed ({listed} keys listed)")
+
+    cache = None if args.no_cache else MetadataCache(args.cache, ttls={'thumb_*_url': args.thumb_url_ttl})
+    if cache is not None and refresh_ids:
+        cache.invalidate(refresh_ids, [thumb_field(size) for size in THUMB_SIZES] + [thumb_field()])
+    progress = None
+    if args.shard is not None:
+        progress = ProgressStore(args.progress, lease_seconds=args.lease_seconds)
+    process_pool = None
+    if args.geotag or args.resize:
+        # spawn: forking a process that already runs threads and holds sqlite connections is unsafe
+        process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=args.tag_workers,
+                                                              mp_context=multiprocessing.get_context('spawn'))
+    sink = build_sink(args, bucket_name, prefix, progress, sync, failures)
+    reporter = Reporter(registry, args.report_interval,
+                        rates=['images_uploaded_total', 'uploaded_bytes_total', 'graph_requests_total'])
+
+    def run(image_ids, shard=None):
+        stages = build_stages(args, bucket_name, prefix, cache, key_index, process_pool, sink, shard, progress, sync,
+                              failures)
+        pipeline = Pipeline(stages, queue_size=args.queue_size, on_error=failure_recorder(failures))
+        for stage in stages:
+            registry.gauge('queue_depth', {'stage': stage.name},
+                           func=lambda name=stage.name: pipeline.queue_depths().get(name, 0))
+        uploaded = pipeline.run(image_ids)
+        for stage in stages:
+            for state in ('in', 'out', 'failed'):
+                registry.counter('stage_items_total', {'stage': stage.name, 'state': state}).inc(
+                    pipeline.stats[stage.name][state])
+            registry.counter('stage_busy_seconds_total', {'stage': stage.name}).inc(pipeline.stats[stage.name]['seconds'])
+            registry.gauge('stage_workers', {'stage': stage.name}).set(stage.workers)
+        return uploaded
+
+    def run_shard(shard):
+        """Lease a work shard and download it; False if another node holds it or completed it."""
+        if not progress.acquire(shard):
+            return False
+        print(f"Working on shard {shard[0]}/{shard[1]}")
+        try:
+            with Heartbeat(progress, shard) as heartbeat:
+                # once the lease is lost the shard belongs to another node: stop feeding it
+                image_ids = peek(until_set(resolve_image_ids(args, shard, failures=failures), heartbeat.lost))
+                uploaded = run(image_ids, shard) if image_ids is not None else 0
+                if isinstance(sink, TarShardSink):
+                    sink.flush()  # the shard is complete only once its images are in finished tar shards
+        except BaseException:
+            progress.release(shard)
+            raise
+        if heartbeat.lost.is_set():
+            print(f"⚠️ Shard {shard[0]}/{shard[1]} left to the node that took it over after {uploaded} images")
+            return True
+        progress.complete(shard)
+        print(f"Shard {shard[0]}/{shard[1]} complete: {uploaded} images")
+        return True
+
+    print("Starting downloads...")
+    start = time.monotonic()
+    try:
+        with reporter:
+            if args.shard is None:
+                run(image_ids)
+            else:
+                worked = []
+                while True:
+                    worked += [shard for shard in shard_order(args.shard) if run_shard(shard) and shard not in worked]
+                    expires_at = progress.next_expiry(args.shard[1])
+                    if expires_at is None:
+                        break
+                    # the other shards are leased: wait until the first lease may have expired, then try again
+                    wait = max(expires_at - time.time(), 0) + 1
+                    print(f"⏳ Waiting {wait:.0f}s for the shards leased by other nodes")
+                    time.sleep(wait)
+                print(f"Shards worked on: {', '.join(f'{i}/{n}' for i, n in worked) or 'none, all taken or complete'}")
+    finally:
+        if process_pool is not None:
+            process_pool.shutdown()
+        try:
+            sink.close()
+        except Exception as e:
+            # its lost images are in the failure journal already; the cleanup below must still run
+            print(f"⚠️ Could not close the {args.sink} sink: {e}")
+        if sync is not None:
+            # after the sink is closed: every image it reported is stored
+            watermarks = sync.commit()
+            for scope, watermark in list(watermarks.items())[:10]:
+                print(f"Synced {scope} up to {iso_time(watermark) if watermark is not None else 'the start'}")
+            if len(watermarks) > 10:
+                print(f"... and {len(watermarks) - 10} more sequences")
+            sync.close()
+        failures.close()
+        if progress is not None:
+            progress.close()
+        if cache is not None:
+            cache.close()
+        if key_index is not None:
+            key_index.close()
+    elapsed = time.monotonic() - start
+
+    uploaded = registry.counter('images_uploaded_total').value
+    print(f"✅ All downloads complete! {uploaded} images in {elapsed:.1f}s ({uploaded / max(elapsed, 1e-9):.1f} images/s)")
+    stats = {}
+    for (name, labels), metric in registry.items():
+        if name in ('stage_items_total', 'stage_busy_seconds_total', 'stage_workers'):
+            labels = dict(labels)
+            stats.setdefault(labels['stage'], {})[labels.get('state', name)] = metric.value
+    for name, stage in stats.items():
+        # what the stage could sustain with its workers if it never waited on its neighbours
+        seconds = stage['stage_busy_seconds_total']
+        capacity = stage['stage_workers'] * stage['in'] / seconds if seconds else 0
+        print(f"   {name}: {stage['in']} in, {stage['out']} out, {stage['failed']} failed, "
+              f"{1000 * seconds / max(stage['in'], 1):.1f} ms/item, capacity {capacity:.1f} items/s")
+    print(f"   Graph API calls/s per token: {token_pool.rates()}")
+    transferred = registry.counter('downloaded_bytes_total' if args.buffered else 'uploaded_bytes_total').value
+    print(f"   Downloaded {transferred / 1e6:.1f} MB from {thumb_field(args.resolution)} ({transferred / 1e3 / max(uploaded, 1):.0f} KB/image, "
+          f"{transferred / 1e6 / max(elapsed, 1e-9):.1f} MB/s)")
+    if args.resize:
+        before = registry.counter('resize_input_bytes_total').value
+        after = registry.counter('resize_output_bytes_total').value
+        print(f"   Resizing to {args.resolution} px saved {(before - after) / 1e6:.1f} MB "
+              f"({100 * (before - after) / max(before, 1):.0f}% of the downloaded bytes)")
+
+    still_failing = failures.counts()
+    if still_failing:
+        print(f"   {sum(still_failing.values())} failures in {args.failures} ({still_failing}), "
+              f"run again with --retry_failed to retry them")
+
+    if args.metrics:
+        for i, rate in enumerate(token_pool.rates().values()):
+            registry.gauge('token_rate', {'token': i}).set(rate)
+        registry.write(args.metrics)
+        print(f"Metrics written to {args.metrics}")
+
+
+if __name__ == '__main__':
+    main()
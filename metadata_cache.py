@@ -0,0 +1,110 @@
+"""
+Persistent SQLite cache for Graph API image metadata.
+
+Values are stored per (image ID, field) with the time they were fetched, so
+fields can expire independently: geometry and capture time never change,
+while `thumb_*_url` values are signed URLs that stop working after a while.
+"""
+import fnmatch
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+THUMB_URL_TTL = 3600
+DEFAULT_TTLS = {"thumb_*_url": THUMB_URL_TTL}
+
+_SQL_CHUNK = 500  # stay well below SQLite's host parameter limit
+
+
+class MetadataCache:
+    def __init__(self, path: str, ttls: Optional[Dict[str, float]] = None) -> None:
+        """
+        `ttls` maps field names or fnmatch patterns to a lifetime in seconds;
+        fields matching no pattern never expire.
+        """
+        self.path = path
+        self.ttls = DEFAULT_TTLS if ttls is None else ttls
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS image_fields ("
+            " image_id TEXT NOT NULL, field TEXT NOT NULL, value TEXT, fetched_at REAL NOT NULL,"
+            " PRIMARY KEY (image_id, field)) WITHOUT ROWID"
+        )
+        self.db.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+    def ttl(self, field: str) -> Optional[float]:
+        for pattern, seconds in self.ttls.items():
+            if fnmatch.fnmatchcase(field, pattern):
+                return seconds
+        return None
+
+    def get_many(self, image_ids: Iterable[str], fields: List[str]) -> Dict[str, dict]:
+        """
+        Return `{image_id: data}` for the IDs whose requested fields are all
+        cached and fresh. Fields the API did not return are cached as absent
+        and left out of `data`, like in an API answer.
+        """
+        fields = [f for f in fields if f != "id"]
+        now = time.time()
+        found: Dict[str, dict] = {}
+        ids = list(image_ids)
+        with self.lock:
+            for start in range(0, len(ids), _SQL_CHUNK):
+                chunk = ids[start:start + _SQL_CHUNK]
+                rows = self.db.execute(
+                    f"SELECT image_id, field, value, fetched_at FROM image_fields"
+                    f" WHERE image_id IN ({','.join('?' * len(chunk))})"
+                    f" AND field IN ({','.join('?' * len(fields))})",
+                    chunk + fields,
+                ).fetchall()
+                for image_id, field, value, fetched_at in rows:
+                    ttl = self.ttl(field)
+                    if ttl is not None and now - fetched_at > ttl:
+                        continue
+                    found.setdefault(image_id, {})[field] = value
+
+        results = {}
+        for image_id, values in found.items():
+            if len(values) < len(fields):
+                continue  # partially cached or stale: refetch the whole entry
+            data = {"id": image_id}
+            for field, value in values.items():
+                if value is not None:
+                    data[field] = json.loads(value)
+            results[image_id] = data
+        return results
+
+    def put_many(self, records: Dict[str, dict], fields: List[str]) -> None:
+        """Store the requested `fields` of every `{image_id: data}` answer."""
+        now = time.time()
+        rows = [
+            (image_id, field, json.dumps(data[field]) if field in data else None, now)
+            for image_id, data in records.items()
+            for field in fields if field != "id"
+        ]
+        if not rows:
+            return
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO image_fields VALUES (?, ?, ?, ?)", rows)
+            self.db.commit()
+
+    def invalidate(self, image_ids: Iterable[str], fields: Optional[List[str]] = None) -> None:
+        """Forget cached values (all fields, or only `fields`) of some images."""
+        ids = list(image_ids)
+        with self.lock:
+            for start in range(0, len(ids), _SQL_CHUNK):
+                chunk = ids[start:start + _SQL_CHUNK]
+                query = f"DELETE FROM image_fields WHERE image_id IN ({','.join('?' * len(chunk))})"
+                if fields:
+                    query += f" AND field IN ({','.join('?' * len(fields))})"
+                self.db.execute(query, chunk + list(fields or []))
+            self.db.commit()
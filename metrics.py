@@ -0,0 +1,247 @@
+"""
+In-process metrics: counters, gauges and latency histograms.
+
+Recording is a lock and an addition, cheap enough for the per-image hot
+path. `Reporter` prints live throughput from a daemon thread, and a
+registry can be written out at the end of a run as JSON or as a Prometheus
+text file (node_exporter's textfile collector reads the latter).
+"""
+import bisect
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+# seconds, 1 ms to about 1 min in steps of 25%: covers a cached metadata lookup up to a slow multipart
+# upload, and keeps interpolated percentiles within a few % of the real ones
+LATENCY_BUCKETS = tuple(round(0.001 * 1.25 ** i, 6) for i in range(50))
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Optional[Dict[str, str]]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in (labels or {}).items()))
+
+
+def _series(name: str, labels: Labels, extra: Labels = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+class Counter:
+    def __init__(self) -> None:
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self.lock:
+            self.value += amount
+
+
+class Gauge:
+    """A value that is set, or read from `func` when the gauge is collected (e.g. a queue size)."""
+
+    def __init__(self, func: Optional[Callable[[], float]] = None) -> None:
+        self.func = func
+        self._value = 0
+
+    def set(self, value: float) -> None:
+        self._value = value
+
+    @property
+    def value(self) -> float:
+        return self.func() if self.func is not None else self._value
+
+
+class Histogram:
+    def __init__(self, buckets: Iterable[float] = LATENCY_BUCKETS) -> None:
+        self.bounds = list(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)  # the last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def quantile(self, q: float) -> float:
+        """Estimate by linear interpolation inside the bucket holding the q-th observation."""
+        with self.lock:
+            counts, total = list(self.counts), self.count
+        if not total:
+            return math.nan
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                if i == len(self.bounds):
+                    return lower  # beyond the last bound: all we know is the lower edge
+                return lower + (self.bounds[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: Dict[Tuple[str, Labels], object] = {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def _get(self, kind, name: str, labels: Optional[Dict[str, str]], **kwargs):
+        key = (name, _labels(labels))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = self.metrics[key] = kind(**kwargs)
+        if not isinstance(metric, kind):
+            raise TypeError(f"{name} is already registered as a {type(metric).__name__}")
+        return metric
+
+    def counter(self, name: str, labels: Optional[Dict[str, str]] = None) -> Counter:
+        return self._get(Counter, name, labels)
+
+    def gauge(self, name: str, labels: Optional[Dict[str, str]] = None,
+              func: Optional[Callable[[], float]] = None) -> Gauge:
+        gauge = self._get(Gauge, name, labels)
+        if func is not None:
+            gauge.func = func
+        return gauge
+
+    def histogram(self, name: str, labels: Optional[Dict[str, str]] = None,
+                  buckets: Iterable[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, labels, buckets=buckets)
+
+    def reset(self) -> None:
+        """Forget every metric, e.g. between two runs in one process."""
+        with self.lock:
+            self.metrics = {}
+            self.started = time.time()
+
+    def items(self):
+        with self.lock:
+            return sorted(self.metrics.items(), key=lambda item: item[0])
+
+    def to_dict(self) -> dict:
+        summary = {"uptime_seconds": time.time() - self.started}
+        for (name, labels), metric in self.items():
+            series = _series(name, labels)
+            if isinstance(metric, Histogram):
+                summary[series] = {
+                    "count": metric.count,
+                    "sum": metric.sum,
+                    "p50": metric.quantile(0.5),
+                    "p90": metric.quantile(0.9),
+                    "p99": metric.quantile(0.99),
+                }
+            else:
+                summary[series] = metric.value
+        return summary
+
+    def to_prometheus(self) -> str:
+        lines = []
+        typed = set()
+        for (name, labels), metric in self.items():
+            kind = {Counter: "counter", Gauge: "gauge", Histogram: "histogram"}[type(metric)]
+            if name not in typed:
+                lines.append(f"# TYPE {name} {kind}")
+                typed.add(name)
+            if isinstance(metric, Histogram):
+                with metric.lock:
+                    counts, total, value_sum = list(metric.counts), metric.count, metric.sum
+                cumulative = 0
+                for bound, count in zip(metric.bounds + [math.inf], counts):
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else repr(bound)
+                    lines.append(f"{_series(name + '_bucket', labels, (('le', le),))} {cumulative}")
+                lines.append(f"{_series(name + '_sum', labels)} {value_sum}")
+                lines.append(f"{_series(name + '_count', labels)} {total}")
+            else:
+                lines.append(f"{_series(name, labels)} {metric.value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """Write the registry to `path`: JSON if it ends in .json, the Prometheus text format otherwise."""
+        if path.lower().endswith(".json"):
+            text = json.dumps(self.to_dict(), indent=2, default=str)
+        else:
+            text = self.to_prometheus()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+
+
+class Reporter:
+    """
+    Print, every `interval` seconds, the rate of the `rates` counters since the
+    previous report, then the p50/p99 of the histograms and the gauges.
+    """
+
+    def __init__(self, registry: Registry, interval: float = 10.0, rates: Iterable[str] = (),
+                 out: Callable[[str], None] = print) -> None:
+        self.registry = registry
+        self.interval = interval
+        self.rates = list(rates)
+        self.out = out
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="metrics-reporter", daemon=True)
+        self.previous = {}
+        self.previous_time = time.monotonic()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        if self.interval > 0:
+            self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def _run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.out(self.report())
+
+    def report(self) -> str:
+        now = time.monotonic()
+        elapsed = max(now - self.previous_time, 1e-9)
+        self.previous_time = now
+        parts = []
+        for name in self.rates:
+            value = sum(metric.value for (n, _), metric in self.registry.items() if n == name)
+            rate = (value - self.previous.get(name, 0)) / elapsed
+            self.previous[name] = value
+            parts.append(f"{name} {rate / 1e6:.2f} MB/s" if "bytes" in name else f"{name} {rate:.1f}/s")
+        for (name, labels), metric in self.registry.items():
+            if isinstance(metric, Histogram) and metric.count:
+                parts.append(f"{_series(name, labels)} p50 {1000 * metric.quantile(0.5):.0f}ms "
+                             f"p99 {1000 * metric.quantile(0.99):.0f}ms")
+            elif isinstance(metric, Gauge):
+                parts.append(f"{_series(name, labels)}={metric.value:g}")
+        return f"[{time.time() - self.registry.started:6.0f}s] " + ", ".join(parts)
+
+
+registry = Registry()  # process-wide default, like the module-level session of the scripts
@@ -0,0 +1,194 @@
+"""
+Parquet export of image metadata, partitioned by geohash.
+
+Rows are written to a Hive-style directory, one partition per geohash cell
+of `precision` characters:
+
+    out.parquet/geohash=u09t/part-00000.parquet
+    out.parquet/_index.json
+
+so a reader can load one region only, e.g. with
+`pyarrow.dataset.dataset(path, partitioning="hive")` filtered on `geohash`,
+or by picking files from `_index.json`, which lists every partition with
+its row count and the bounding box of its rows. Rows without coordinates go
+to the `geohash=_` partition.
+
+Rows are streamed: each partition buffers at most `row_group_size` rows
+before they are written as a row group, and the largest buffer is written
+early when all of them together hold more than `4 * row_group_size`, so
+memory does not grow with the export. Row groups carry min/max statistics
+of lat/lon, which lets readers skip them inside a partition too.
+
+pyarrow is only needed for this export (`pip install pyarrow`).
+"""
+import glob
+import json
+import os
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional
+
+DEFAULT_PRECISION = 4  # cells of about 39 x 20 km
+DEFAULT_ROW_GROUP_SIZE = 100_000
+INDEX_NAME = "_index.json"
+NO_POSITION = "_"
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash(lat: float, lon: float, precision: int = DEFAULT_PRECISION) -> str:
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits, value, even = 0, 0, True
+    while len(chars) < precision:
+        interval, coordinate = (lon_range, lon) if even else (lat_range, lat)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_BASE32[value])
+            bits, value = 0, 0
+    return "".join(chars)
+
+
+def _number(value) -> Optional[float]:
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if value != value else value  # NaN
+
+
+class _Partition:
+    def __init__(self, cell: str) -> None:
+        self.cell = cell
+        self.rows = []
+        self.parts = []  # relative paths of the files written
+        self.count = 0
+        self.bbox = None  # [west, south, east, north]
+
+    def add(self, row: dict) -> None:
+        self.rows.append(row)
+        self.count += 1
+        lat, lon = row["lat"], row["lon"]
+        if lat is not None and lon is not None:
+            if self.bbox is None:
+                self.bbox = [lon, lat, lon, lat]
+            else:
+                self.bbox = [min(self.bbox[0], lon), min(self.bbox[1], lat),
+                             max(self.bbox[2], lon), max(self.bbox[3], lat)]
+
+
+class ParquetExporter:
+    """
+    Write rows with `image_id`, `image_name`, `lat`, `lon` and `url` to a geohash-partitioned Parquet directory.
+
+    At most `max_open_files` partition files are open at once; a partition evicted
+    past that continues in a new part file.
+    """
+
+    def __init__(self, root: str, precision: int = DEFAULT_PRECISION,
+                 row_group_size: int = DEFAULT_ROW_GROUP_SIZE, max_open_files: int = 64) -> None:
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("The Parquet export needs pyarrow: pip install pyarrow")
+        self.pa, self.pq = pa, pq
+        self.schema = pa.schema([
+            ("image_id", pa.string()),
+            ("image_name", pa.string()),
+            ("lat", pa.float64()),
+            ("lon", pa.float64()),
+            ("url", pa.string()),
+        ])
+        self.root = root
+        self.precision = precision
+        self.row_group_size = row_group_size
+        self.max_open_files = max_open_files
+        self.partitions: Dict[str, _Partition] = {}
+        self.writers = OrderedDict()  # cell -> ParquetWriter, least recently used first
+        self.buffered = 0
+        os.makedirs(root, exist_ok=True)
+        # like the xlsx/csv outputs, a new export replaces the previous one
+        for path in glob.glob(os.path.join(root, "geohash=*", "part-*.parquet")):
+            os.remove(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def write(self, record: dict) -> None:
+        lat, lon = _number(record.get("lat")), _number(record.get("lon"))
+        cell = geohash(lat, lon, self.precision) if lat is not None and lon is not None else NO_POSITION
+        partition = self.partitions.get(cell)
+        if partition is None:
+            partition = self.partitions[cell] = _Partition(cell)
+        partition.add({
+            "image_id": str(record.get("image_id")),
+            "image_name": record.get("image_name"),
+            "lat": lat,
+            "lon": lon,
+            "url": record.get("url"),
+        })
+        self.buffered += 1
+        if len(partition.rows) >= self.row_group_size:
+            self._flush(partition)
+        elif self.buffered > 4 * self.row_group_size:
+            self._flush(max(self.partitions.values(), key=lambda p: len(p.rows)))
+
+    def write_all(self, records: Iterable[dict]) -> int:
+        count = 0
+        for record in records:
+            self.write(record)
+            count += 1
+        return count
+
+    def _writer(self, partition: _Partition):
+        writer = self.writers.get(partition.cell)
+        if writer is not None:
+            self.writers.move_to_end(partition.cell)
+            return writer
+        if len(self.writers) >= self.max_open_files:
+            _, oldest = self.writers.popitem(last=False)
+            oldest.close()
+        directory = os.path.join(self.root, f"geohash={partition.cell}")
+        os.makedirs(directory, exist_ok=True)
+        name = f"geohash={partition.cell}/part-{len(partition.parts):05d}.parquet"
+        partition.parts.append(name)
+        writer = self.writers[partition.cell] = self.pq.ParquetWriter(os.path.join(self.root, name), self.schema,
+                                                                      compression="zstd")
+        return writer
+
+    def _flush(self, partition: _Partition) -> None:
+        if partition.rows:
+            self._writer(partition).write_table(self.pa.Table.from_pylist(partition.rows, schema=self.schema))
+            self.buffered -= len(partition.rows)
+            partition.rows = []
+
+    def close(self) -> None:
+        for partition in self.partitions.values():
+            self._flush(partition)
+        for writer in self.writers.values():
+            writer.close()
+        self.writers.clear()
+        index = {
+            "partitioning": "hive",
+            "column": "geohash",
+            "precision": self.precision,
+            "partitions": [{"geohash": p.cell, "files": p.parts, "rows": p.count, "bbox": p.bbox}
+                           for p in sorted(self.partitions.values(), key=lambda p: p.cell)],
+        }
+        with open(os.path.join(self.root, INDEX_NAME), "w", encoding="utf-8") as f:
+            json.dump(index, f, indent=1)
+
+    @property
+    def rows(self) -> int:
+        return sum(p.count for p in self.partitions.values())
@@ -0,0 +1,154 @@
+"""
+Staged asyncio pipeline used by mapillary_download.py.
+
+Every stage has its own worker count and is connected to the next one by a
+bounded queue, so a slow stage applies backpressure upstream instead of
+letting work pile up in memory. Stage functions are plain blocking callables
+(requests / boto3 calls); they run on a shared thread pool.
+"""
+import asyncio
+import concurrent.futures
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, List, Optional
+
+_DONE = object()
+
+
+@dataclass
+class Stage:
+    """
+    A pipeline step.
+
+    `func(item)` returns the item to hand to the next stage, or None to drop it.
+    With `fan_out=True` it returns an iterable instead and every element is
+    forwarded (lazily, so a long iterable is streamed rather than collected).
+    With a `batch_size` it receives a list of up to `batch_size` items that
+    were already waiting in the queue (a list of one with `batch_size=1`)
+    and behaves as a fan-out stage.
+    """
+    name: str
+    func: Callable[[Any], Any]
+    workers: int = 1
+    fan_out: bool = False
+    batch_size: Optional[int] = None
+
+
+class Pipeline:
+    def __init__(self, stages: List[Stage], queue_size: int = 256,
+                 on_error: Optional[Callable[[Stage, Any, Exception], None]] = None) -> None:
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage")
+        self.stages = stages
+        self.queue_size = queue_size
+        self.on_error = on_error or self._print_error
+        # "seconds" is the time spent in the stage function, summed over its workers
+        self.stats = {stage.name: {"in": 0, "out": 0, "failed": 0, "seconds": 0.0} for stage in stages}
+        self.queues: List[asyncio.Queue] = []
+
+    def queue_depths(self) -> dict:
+        """Items waiting in front of each stage; a full queue points at a slow stage (or one right after it)."""
+        return {stage.name: queue.qsize() for stage, queue in zip(self.stages, self.queues)}
+
+    @staticmethod
+    def _print_error(stage: Stage, item: Any, error: Exception) -> None:
+        print(f"⚠️ {stage.name} failed for {item}: {error}")
+
+    def run(self, source: Iterable) -> int:
+        """Push every element of `source` through the stages, return how many came out the end."""
+        return asyncio.run(self.run_async(source))
+
+    async def run_async(self, source: Iterable) -> int:
+        loop = asyncio.get_running_loop()
+        threads = sum(stage.workers for stage in self.stages) + 1
+        queues = self.queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            tasks = [asyncio.create_task(self._feed(loop, executor, iter(source), queues[0]))]
+            for i, stage in enumerate(self.stages):
+                tasks.append(asyncio.create_task(
+                    self._run_stage(loop, executor, stage, queues[i], queues[i + 1])))
+            completed = asyncio.create_task(self._drain(queues[-1]))
+            try:
+                await asyncio.gather(*tasks)
+                return await completed
+            except BaseException:
+                for task in tasks + [completed]:
+                    task.cancel()
+                raise
+
+    async def _feed(self, loop, executor, iterator, outbox: asyncio.Queue) -> None:
+        while True:
+            item = await loop.run_in_executor(executor, next, iterator, _DONE)
+            if item is _DONE:
+                break
+            await outbox.put(item)
+        await outbox.put(_DONE)
+
+    async def _run_stage(self, loop, executor, stage: Stage, inbox: asyncio.Queue, outbox: asyncio.Queue) -> None:
+        await asyncio.gather(*(self._worker(loop, executor, stage, inbox, outbox)
+                               for _ in range(stage.workers)))
+        await outbox.put(_DONE)
+
+    async def _worker(self, loop, executor, stage: Stage, inbox: asyncio.Queue, outbox: asyncio.Queue) -> None:
+        stats = self.stats[stage.name]
+        while True:
+            item = await inbox.get()
+            if item is _DONE:
+                # leave the marker in place for the sibling workers of this stage
+                await inbox.put(_DONE)
+                return
+            if stage.batch_size is not None:
+                item = self._take_batch(item, inbox, stage.batch_size)
+                stats["in"] += len(item)
+            else:
+                stats["in"] += 1
+            started = time.perf_counter()
+            try:
+                if stage.fan_out or stage.batch_size is not None:
+                    results = await loop.run_in_executor(executor, lambda: iter(stage.func(item)))
+                    while True:
+                        result = await loop.run_in_executor(executor, next, results, _DONE)
+                        if result is _DONE:
+                            break
+                        stats["out"] += 1
+                        # time blocked on a full outbox is backpressure, not work
+                        stats["seconds"] += time.perf_counter() - started
+                        await outbox.put(result)
+                        started = time.perf_counter()
+                else:
+                    result = await loop.run_in_executor(executor, stage.func, item)
+                    stats["seconds"] += time.perf_counter() - started
+                    started = None
+                    if result is not None:
+                        stats["out"] += 1
+                        await outbox.put(result)
+            except Exception as e:
+                stats["failed"] += 1
+                self.on_error(stage, item, e)
+            if started is not None:
+                stats["seconds"] += time.perf_counter() - started
+
+    @staticmethod
+    def _take_batch(first: Any, inbox: asyncio.Queue, batch_size: int) -> list:
+        """Complete a batch with the items already queued, without waiting for more."""
+        batch = [first]
+        while len(batch) < batch_size:
+            try:
+                item = inbox.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            if item is _DONE:
+                inbox.put_nowait(_DONE)
+                break
+            batch.append(item)
+        return batch
+
+    @staticmethod
+    async def _drain(inbox: asyncio.Queue) -> int:
+        count = 0
+        while True:
+            item = await inbox.get()
+            if item is _DONE:
+                return count
+            count += 1
@@ -0,0 +1,192 @@
+"""
+Progress shared by several nodes downloading the same dataset.
+
+Image IDs are split into N shards by a stable hash, so every node computes
+the same split from the same input. A node leases a shard in a shared SQLite
+file before working on it and keeps the lease alive with a heartbeat; a
+lease that is not renewed expires, and the shard can then be taken over by
+another node. Every stored image is recorded as done, so whoever works on a
+shard (again) skips what was already stored instead of re-diffing the bucket.
+
+SQLite locking needs a filesystem that implements it properly: a local disk
+for several processes on one machine, or a network filesystem with working
+locks (e.g. NFSv4, EFS) for several machines.
+"""
+import hashlib
+import os
+import socket
+import sqlite3
+import threading
+import time
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+DEFAULT_LEASE_SECONDS = 300
+
+_SQL_CHUNK = 500
+_WRITE_BATCH = 100  # done IDs lost by a crash are downloaded again, keep this small
+
+Shard = Tuple[int, int]  # (index, count)
+
+
+def parse_shard(text: str) -> Shard:
+    """'i/N' -> (i, N)."""
+    index, _, count = text.partition('/')
+    index, count = int(index), int(count)
+    if not 0 <= index < count:
+        raise ValueError(f"Invalid shard {text!r}: expected i/N with 0 <= i < N")
+    return index, count
+
+
+def shard_of(image_id: str, count: int) -> int:
+    """Shard of an image ID; stable across processes and machines, unlike hash()."""
+    digest = hashlib.blake2b(str(image_id).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % count
+
+
+def in_shard(image_id: str, shard: Optional[Shard]) -> bool:
+    return shard is None or shard_of(image_id, shard[1]) == shard[0]
+
+
+def shard_order(shard: Shard) -> List[Shard]:
+    """The shards a node works on: its own first, then the following ones (to take over stalled ones)."""
+    index, count = shard
+    return [((index + i) % count, count) for i in range(count)]
+
+
+def until_set(items: Iterable, event: threading.Event) -> Iterator:
+    """The items, stopping as soon as `event` is set."""
+    for item in items:
+        if event.is_set():
+            return
+        yield item
+
+
+class ProgressStore:
+    def __init__(self, path: str, owner: Optional[str] = None, lease_seconds: float = DEFAULT_LEASE_SECONDS) -> None:
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.lock = threading.Lock()
+        self.pending = []
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS shards ("
+            " shard INTEGER NOT NULL, count INTEGER NOT NULL, owner TEXT, expires_at REAL, completed_at REAL,"
+            " PRIMARY KEY (shard, count))"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS done_ids ("
+            " image_id TEXT PRIMARY KEY, shard INTEGER, done_at REAL NOT NULL) WITHOUT ROWID"
+        )
+
+    def close(self) -> None:
+        self.flush()
+        with self.lock:
+            self.db.close()
+
+    def acquire(self, shard: Shard) -> bool:
+        """Lease a shard unless it is completed or leased by another live node."""
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute("SELECT owner, expires_at, completed_at FROM shards WHERE shard = ? AND count = ?",
+                                      shard).fetchone()
+                if row is not None:
+                    owner, expires_at, completed_at = row
+                    if completed_at is not None or (owner not in (None, self.owner) and expires_at > now):
+                        self.db.execute("ROLLBACK")
+                        return False
+                    if owner not in (None, self.owner):
+                        print(f"Taking over shard {shard[0]}/{shard[1]} from {owner}, whose lease expired")
+                self.db.execute("INSERT OR REPLACE INTO shards VALUES (?, ?, ?, ?, NULL)",
+                                (*shard, self.owner, now + self.lease_seconds))
+                self.db.execute("COMMIT")
+                return True
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def renew(self, shard: Shard) -> bool:
+        """Extend our lease; False if it was lost (expired and taken over)."""
+        with self.lock:
+            cursor = self.db.execute(
+                "UPDATE shards SET expires_at = ? WHERE shard = ? AND count = ? AND owner = ? AND completed_at IS NULL",
+                (time.time() + self.lease_seconds, *shard, self.owner))
+            return cursor.rowcount == 1
+
+    def complete(self, shard: Shard) -> None:
+        self.flush()
+        with self.lock:
+            self.db.execute("UPDATE shards SET completed_at = ? WHERE shard = ? AND count = ? AND owner = ?",
+                            (time.time(), *shard, self.owner))
+
+    def release(self, shard: Shard) -> None:
+        """Give a shard back without completing it (e.g. on Ctrl-C), so another node can take it at once."""
+        self.flush()
+        with self.lock:
+            self.db.execute("UPDATE shards SET owner = NULL, expires_at = 0 WHERE shard = ? AND count = ? AND owner = ?",
+                            (*shard, self.owner))
+
+    def next_expiry(self, count: int) -> Optional[float]:
+        """When the first lease on a shard of `count` not completed expires (0 if one is free); None once all are."""
+        with self.lock:
+            rows = self.db.execute("SELECT expires_at, completed_at FROM shards WHERE count = ?", (count,)).fetchall()
+        leases = [expires_at or 0 for expires_at, completed_at in rows if completed_at is None]
+        completed = len(rows) - len(leases)
+        if completed >= count:
+            return None
+        return min(leases) if completed + len(leases) == count else 0.0  # some shard was never leased
+
+    def done(self, image_ids: Iterable[str]) -> Set[str]:
+        """The subset of `image_ids` already stored by any node."""
+        image_ids = list(image_ids)
+        found = set()
+        with self.lock:
+            for start in range(0, len(image_ids), _SQL_CHUNK):
+                chunk = image_ids[start:start + _SQL_CHUNK]
+                rows = self.db.execute(
+                    f"SELECT image_id FROM done_ids WHERE image_id IN ({','.join('?' * len(chunk))})", chunk)
+                found.update(image_id for (image_id,) in rows)
+        return found
+
+    def add(self, image_id: str, shard: Optional[Shard] = None) -> None:
+        """Record a stored image; writes are batched, see `flush`."""
+        with self.lock:
+            self.pending.append((str(image_id), shard[0] if shard else None, time.time()))
+            if len(self.pending) < _WRITE_BATCH:
+                return
+        self.flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            if self.pending:
+                self.db.execute("BEGIN IMMEDIATE")
+                self.db.executemany("INSERT OR IGNORE INTO done_ids VALUES (?, ?, ?)", self.pending)
+                self.db.execute("COMMIT")
+                self.pending = []
+
+
+class Heartbeat:
+    """Renew the lease on a shard (and flush the done IDs) every third of the lease, from a daemon thread."""
+
+    def __init__(self, store: ProgressStore, shard: Shard) -> None:
+        self.store = store
+        self.shard = shard
+        self.stopped = threading.Event()
+        self.lost = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="progress-heartbeat", daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self) -> None:
+        while not self.stopped.wait(self.store.lease_seconds / 3):
+            self.store.flush()
+            if not self.store.renew(self.shard) and not self.lost.is_set():
+                self.lost.set()
+                print(f"⚠️ Lost the lease on shard {self.shard[0]}/{self.shard[1]}; another node may be working on it")
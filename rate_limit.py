@@ -0,0 +1,121 @@
+"""
+Adaptive rate limiting for the Mapillary Graph API.
+
+Each access token gets its own token bucket. The bucket rate follows an
+additive-increase / multiplicative-decrease rule: every successful call
+raises it a little, every throttling answer (HTTP 429 or Mapillary error
+code -2) halves it. A TokenPool spreads calls across several access tokens,
+always picking the one that can be used soonest, so aggregate throughput
+grows with the number of valid tokens.
+"""
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+THROTTLE_STATUSES = (429,)
+THROTTLE_CODES = (-2,)
+INVALID_TOKEN_STATUSES = (401,)
+INVALID_TOKEN_CODES = (190,)  # OAuthException: invalid or expired access token
+
+
+class NoValidTokenError(RuntimeError):
+    pass
+
+
+def is_throttled(status: Optional[int], code: Optional[int] = None) -> bool:
+    return status in THROTTLE_STATUSES or code in THROTTLE_CODES
+
+
+def is_invalid_token(status: Optional[int], code: Optional[int] = None) -> bool:
+    return status in INVALID_TOKEN_STATUSES or code in INVALID_TOKEN_CODES
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float = 1, min_rate: float = 0.2, max_rate: float = 100,
+                 increase: float = 0.1) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.throttled_count = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        """Seconds until a call would be allowed."""
+        with self.lock:
+            self._refill(time.monotonic())
+            return max(0.0, (1 - self.tokens) / self.rate)
+
+    def try_acquire(self) -> float:
+        """Take a token if one is available and return 0, otherwise return how long to wait."""
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self) -> None:
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def succeeded(self) -> None:
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def throttled(self) -> None:
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)  # do not let a burst go out right after being throttled
+            self.throttled_count += 1
+
+
+class TokenPool:
+    def __init__(self, access_tokens: Iterable[str], rate: float = 5, max_rate: float = 100, **bucket_kwargs) -> None:
+        tokens = list(dict.fromkeys(t for t in access_tokens if t))  # de-duplicate, keep order
+        if not tokens:
+            raise NoValidTokenError("No access token given")
+        self.buckets: Dict[str, TokenBucket] = {
+            token: TokenBucket(rate, max_rate=max_rate, **bucket_kwargs) for token in tokens
+        }
+        self.invalid = set()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> str:
+        """Block until one of the valid tokens may be used, and return it."""
+        while True:
+            with self.lock:
+                candidates = [(bucket.wait_time(), token) for token, bucket in self.buckets.items()
+                              if token not in self.invalid]
+            if not candidates:
+                raise NoValidTokenError("Every access token was rejected by the Graph API")
+            wait, token = min(candidates)
+            if wait:
+                time.sleep(wait)
+            if not self.buckets[token].try_acquire():
+                return token
+
+    def report(self, token: str, status: Optional[int], code: Optional[int] = None) -> None:
+        """Feed the outcome of a call made with `token` back into its bucket."""
+        bucket = self.buckets[token]
+        if is_throttled(status, code):
+            bucket.throttled()
+        elif is_invalid_token(status, code):
+            with self.lock:
+                self.invalid.add(token)
+            print(f"⚠️ Access token {token[:12]}… rejected by the Graph API, no longer used")
+        elif status is not None and status < 400:
+            bucket.succeeded()
+
+    def rates(self) -> Dict[str, float]:
+        return {token[:12]: bucket.rate for token, bucket in self.buckets.items() if token not in self.invalid}
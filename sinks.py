@@ -0,0 +1,230 @@
+"""
+Output sinks of mapillary_download.py: where the downloaded images end up.
+
+Every sink has `write(image_id, content, metadata) -> location` (called from
+several pipeline workers at once) and `close()`:
+  - S3ObjectSink: one `{prefix}{id}.jpg` object per image;
+  - LocalDirectorySink: one `{id}.jpg` file per image;
+  - TarShardSink: WebDataset-style tar shards, `{id}.jpg` followed by
+    `{id}.json` (the image metadata), rolled over at a count or size limit.
+    Shards are streamed (to S3 through a multipart upload, or to local
+    files), so a shard is never held in memory. Every shard gets an index
+    of the byte ranges of its members, and the sink writes a manifest of
+    its shards when closed. An image in a tar shard is only safe once the
+    shard is finished, which `on_commit` reports; the images of a shard
+    dropped after an error are reported to `on_drop`.
+"""
+import itertools
+import json
+import os
+import queue
+import tarfile
+import threading
+import time
+from io import BytesIO
+from typing import BinaryIO, Callable, List, Optional
+
+from transfer import DEFAULT_PART_SIZE, S3MultipartWriter
+
+DEFAULT_SHARD_COUNT = 10000  # images per shard
+DEFAULT_SHARD_SIZE = 1024 * 1024 * 1024  # bytes per shard
+MANIFEST_NAME = "shards.json"
+
+Opener = Callable[[str], BinaryIO]  # name -> writable file object, the data is committed on close()
+
+
+def object_key(prefix, image_id):
+    return f"{prefix}{image_id}.jpg"  # The filename inside S3
+
+
+def metadata_record(image_data):
+    """What is stored next to an image: its Graph API fields, without the signed (expiring) thumbnail URLs."""
+    return {field: value for field, value in image_data.items()
+            if field != 'content' and not (field.startswith('thumb_') and field.endswith('_url'))}
+
+
+class S3ObjectSink:
+    def __init__(self, upload: Callable[[bytes, str, str], None], bucket_name: str, prefix: str = '') -> None:
+        self.upload = upload  # (content, bucket_name, key_name)
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+
+    def write(self, image_id, content, metadata=None):
+        key_name = object_key(self.prefix, image_id)
+        self.upload(content, self.bucket_name, key_name)
+        return key_name
+
+    def close(self):
+        pass
+
+
+class LocalDirectorySink:
+    def __init__(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def write(self, image_id, content, metadata=None):
+        path = os.path.join(self.directory, f"{image_id}.jpg")
+        # a crash never leaves a truncated image behind under the final name
+        with open(path + '.part', 'wb') as f:
+            f.write(content)
+        os.replace(path + '.part', path)
+        return path
+
+    def close(self):
+        pass
+
+
+def local_opener(directory: str) -> Opener:
+    os.makedirs(directory, exist_ok=True)
+    return lambda name: open(os.path.join(directory, name), 'wb')
+
+
+def s3_opener(s3_client, bucket_name: str, prefix: str = '', part_size: int = DEFAULT_PART_SIZE) -> Opener:
+    return lambda name: S3MultipartWriter(s3_client, bucket_name, f"{prefix}{name}", part_size=part_size)
+
+
+class _Shard:
+    """One tar shard being written; its members' byte ranges go to its index."""
+
+    def __init__(self, opener: Opener, name: str) -> None:
+        self.name = name
+        self.file = opener(name)
+        self.tar = tarfile.open(fileobj=self.file, mode='w|', format=tarfile.USTAR_FORMAT)
+        self.index = {}
+        self.count = 0
+
+    @property
+    def size(self):
+        return self.tar.offset
+
+    def add(self, name, data):
+        """Append a member, return (offset, size) of its data in the shard."""
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self.tar.addfile(info, BytesIO(data))
+        padded = -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        return self.tar.offset - padded, len(data)
+
+    def write(self, image_id, content, metadata):
+        offset, size = self.add(f"{image_id}.jpg", content)
+        entry = {"offset": offset, "size": size}
+        if metadata is not None:
+            offset, size = self.add(f"{image_id}.json", json.dumps(metadata, separators=(',', ':')).encode())
+            entry.update(metadata_offset=offset, metadata_size=size)
+        self.index[str(image_id)] = entry
+        self.count += 1
+
+    def close(self):
+        self.tar.close()
+        self.file.close()
+
+    def abort(self):
+        # the tar stream would flush its buffer into the aborted file when collected
+        self.tar.closed = self.tar.fileobj.closed = True
+        abort = getattr(self.file, 'abort', None)
+        if abort is not None:
+            abort()
+        else:
+            self.file.close()
+
+
+class TarShardSink:
+    """
+    Tar shards named `{name}-{n:06d}.tar`, each with a `{name}-{n:06d}.index.json`.
+
+    `writers` shards are open at the same time so that concurrent pipeline
+    workers do not queue behind each other (a write may upload a multipart
+    part); a shard is closed once it holds `max_count` images or `max_size`
+    bytes. `on_commit` gets the image IDs of every finished shard, `on_drop`
+    the image IDs of a shard lost to an error (but the one whose write
+    raised) and the error.
+    """
+
+    def __init__(self, opener: Opener, writers: int = 4, max_count: int = DEFAULT_SHARD_COUNT,
+                 max_size: int = DEFAULT_SHARD_SIZE, name: str = 'shard', manifest: str = MANIFEST_NAME,
+                 on_commit: Optional[Callable[[List[str]], None]] = None,
+                 on_drop: Optional[Callable[[List[str], Exception], None]] = None) -> None:
+        self.opener = opener
+        self.max_count = max_count
+        self.max_size = max_size
+        self.name = name
+        self.manifest = manifest
+        self.on_commit = on_commit
+        self.on_drop = on_drop
+        self.writers = writers
+        self.numbers = itertools.count()
+        self.lock = threading.Lock()
+        self.shards = []  # manifest entries of the closed shards
+        self.slots = queue.Queue()
+        for _ in range(writers):
+            self.slots.put(None)  # a slot opens its shard on first write
+
+    def _open(self) -> _Shard:
+        with self.lock:
+            number = next(self.numbers)
+        return _Shard(self.opener, f"{self.name}-{number:06d}.tar")
+
+    def _finish(self, shard: _Shard) -> None:
+        shard.close()
+        index_name = shard.name[:-len('.tar')] + '.index.json'
+        with self.opener(index_name) as f:
+            f.write(json.dumps({"shard": shard.name, "members": shard.index}).encode())
+        with self.lock:
+            self.shards.append({"shard": shard.name, "index": index_name, "count": shard.count, "size": shard.size})
+        if self.on_commit is not None:
+            self.on_commit(list(shard.index))
+
+    def _drop(self, shard: _Shard, error: Exception, image_id=None) -> None:
+        """Abort a shard broken by `error` and report its images, but `image_id` (the caller reports that one)."""
+        print(f"⚠️ Dropping shard {shard.name} and its {shard.count} images after a write error: {error}")
+        try:
+            shard.abort()
+        except Exception as e:
+            print(f"⚠️ Could not abort shard {shard.name}: {e}")
+        if self.on_drop is not None:
+            self.on_drop([i for i in shard.index if i != str(image_id)], error)
+
+    def write(self, image_id, content, metadata=None):
+        shard: Optional[_Shard] = self.slots.get()
+        try:
+            if shard is None:
+                shard = self._open()
+            shard.write(image_id, content, metadata)
+            location = shard.name
+            if shard.count >= self.max_count or shard.size >= self.max_size:
+                self._finish(shard)
+                shard = None
+        except Exception as e:
+            if shard is not None:
+                # a shard broken mid-member (or not finished) is not worth keeping
+                self._drop(shard, e, image_id)
+                shard = None
+            raise
+        finally:
+            self.slots.put(shard)
+        return location
+
+    def flush(self):
+        """Finish the open shards, even if not full; call it when no write is in progress."""
+        error = None
+        for _ in range(self.writers):
+            shard = self.slots.get()
+            try:
+                if shard is not None and shard.count:
+                    self._finish(shard)
+            except Exception as e:
+                self._drop(shard, e)
+                error = error or e
+            finally:
+                self.slots.put(None)
+        if error is not None:
+            raise error
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            with self.opener(self.manifest) as f:
+                f.write(json.dumps({"shards": sorted(self.shards, key=lambda s: s["shard"])}, indent=1).encode())
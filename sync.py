@@ -0,0 +1,171 @@
+"""
+Watermarks of the --sync mode of mapillary_download.py.
+
+A synced scope is a sequence or a bounding box. For each one the state keeps
+the `captured_at` watermark (ms since epoch) and the IDs already stored, so
+a rerun only fetches what is new:
+  - a box is searched with `start_captured_at` at its watermark, so only
+    images captured since come back; the seen IDs drop the few captured
+    exactly at the watermark;
+  - the listing of a sequence cannot be filtered by date, but it is a few
+    cheap pages: its seen IDs are dropped before any metadata request.
+
+Scopes can overlap (a sequence crossing a synced box): an image listed by
+several scopes is only handed out once per run, and once stored by any of
+them it counts as stored for all of them.
+
+During a run the new IDs of every scope are tracked in memory; `commit`
+then records the stored ones and moves the watermarks in one transaction.
+A watermark only moves past the images of a scope that were all stored and
+listed to the end: after a failure it stops at the oldest failed image (or
+stays where it was if that image's date is unknown).
+"""
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, Optional, Set
+
+_SQL_CHUNK = 500
+
+
+def iso_time(captured_at: int) -> str:
+    """captured_at (ms since epoch) as the ISO 8601 time the Graph API search parameters take."""
+    return datetime.fromtimestamp(captured_at / 1000, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def sequence_scope(sequence_id: str) -> str:
+    return f"sequence:{sequence_id}"
+
+
+def bbox_scope(bbox) -> str:
+    return "bbox:" + ",".join(map(str, bbox))
+
+
+class _Run:
+    """What happened to the new images of one scope during this run."""
+
+    def __init__(self) -> None:
+        self.listed = False  # the listing was read to the end
+        self.missed = False  # part of the listing failed (e.g. a bbox tile): the listing is not complete
+        self.pending: Dict[str, Optional[int]] = {}  # not stored (yet): ID -> captured_at if known
+        self.stored: Dict[str, Optional[int]] = {}
+
+
+class SyncState:
+    def __init__(self, path: str) -> None:
+        self.lock = threading.Lock()
+        self.runs: Dict[str, _Run] = {}
+        self.scopes: Dict[str, Set[str]] = {}  # ID -> scopes, for the IDs tracked in this run
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS watermarks ("
+            " scope TEXT PRIMARY KEY, captured_at INTEGER, synced_at REAL NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS seen ("
+            " scope TEXT NOT NULL, image_id TEXT NOT NULL, PRIMARY KEY (scope, image_id)) WITHOUT ROWID"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS seen_image_id ON seen (image_id)")
+        self.db.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+    def watermark(self, scope: str) -> Optional[int]:
+        with self.lock:
+            row = self.db.execute("SELECT captured_at FROM watermarks WHERE scope = ?", (scope,)).fetchone()
+        return row[0] if row else None
+
+    def _unseen(self, scope: str, image_ids: list) -> list:
+        """The IDs to download: not seen by this scope before, nor stored through another scope, nor handed out."""
+        new = []
+        with self.lock:
+            seen = {}  # ID -> scopes it was stored through by previous runs
+            for start in range(0, len(image_ids), _SQL_CHUNK):
+                chunk = image_ids[start:start + _SQL_CHUNK]
+                rows = self.db.execute(
+                    f"SELECT image_id, scope FROM seen WHERE image_id IN ({','.join('?' * len(chunk))})", chunk)
+                for image_id, seen_scope in rows:
+                    seen.setdefault(image_id, set()).add(seen_scope)
+            run = self.runs.setdefault(scope, _Run())
+            for image_id in image_ids:
+                if scope in seen.get(image_id, ()) or image_id in run.pending or image_id in run.stored:
+                    continue
+                if image_id in seen:
+                    run.stored[image_id] = None  # stored through another scope by a previous run
+                    continue
+                others = self.scopes.setdefault(image_id, set())
+                if not others:
+                    run.pending[image_id] = None
+                    new.append(image_id)
+                    others.add(scope)
+                    continue
+                # handed out by another scope of this run already: share its outcome
+                other = self.runs[next(iter(others))]
+                if image_id in other.stored:
+                    run.stored[image_id] = other.stored[image_id]
+                else:
+                    run.pending[image_id] = other.pending[image_id]
+                others.add(scope)
+        return new
+
+    def track(self, scope: str, image_ids: Iterable[str], batch_size: int = _SQL_CHUNK) -> Iterator[str]:
+        """Yield the IDs of a scope's listing not seen by a previous run, and track them until `commit`."""
+        self.runs.setdefault(scope, _Run())
+        batch = []
+        for image_id in image_ids:
+            batch.append(str(image_id))
+            if len(batch) >= batch_size:
+                yield from self._unseen(scope, batch)
+                batch = []
+        yield from self._unseen(scope, batch)
+        with self.lock:
+            self.runs[scope].listed = not self.runs[scope].missed
+
+    def missed(self, scope: str) -> None:
+        """Part of a scope's listing failed: its watermark must not move past the images it did not return."""
+        with self.lock:
+            run = self.runs.setdefault(scope, _Run())
+            run.missed, run.listed = True, False
+
+    def note(self, image_id: str, captured_at: Optional[int]) -> None:
+        """Remember the date of a tracked image, from its metadata."""
+        with self.lock:
+            for scope in self.scopes.get(image_id, ()):
+                if image_id in self.runs[scope].pending:
+                    self.runs[scope].pending[image_id] = captured_at
+
+    def stored(self, image_id: str) -> None:
+        """A tracked image is stored (or was found already in the destination)."""
+        with self.lock:
+            for scope in self.scopes.get(image_id, ()):
+                run = self.runs[scope]
+                if image_id in run.pending:
+                    run.stored[image_id] = run.pending.pop(image_id)
+
+    def commit(self) -> Dict[str, Optional[int]]:
+        """Record the stored IDs and move the watermarks, atomically; returns the new watermark of every scope."""
+        watermarks = {}
+        with self.lock:
+            with self.db:  # one transaction
+                for scope, run in self.runs.items():
+                    row = self.db.execute("SELECT captured_at FROM watermarks WHERE scope = ?", (scope,)).fetchone()
+                    watermark = row[0] if row else None
+                    failed = list(run.pending.values())
+                    if failed:
+                        if None not in failed:
+                            watermark = min(failed)
+                    elif run.listed:
+                        dates = [d for d in run.stored.values() if d is not None]
+                        if dates:
+                            watermark = max(dates + ([watermark] if watermark is not None else []))
+                    self.db.executemany("INSERT OR IGNORE INTO seen VALUES (?, ?)",
+                                        [(scope, image_id) for image_id in run.stored])
+                    self.db.execute("INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?)",
+                                    (scope, watermark, time.time()))
+                    watermarks[scope] = watermark
+            self.runs, self.scopes = {}, {}
+        return watermarks
@@ -0,0 +1,63 @@
+"""
+EXIF/XMP geotagging of downloaded images with writer.Writer.
+
+pyexiv2 is native, CPU-bound code, so `tag_image` is meant to run in a
+process pool; it only takes picklable arguments (image bytes and the Graph
+API fields below) and imports writer.py in the worker process.
+"""
+from datetime import datetime, timezone
+
+TAG_FIELDS = 'computed_geometry,compass_angle,captured_at,camera_type'
+
+SPHERICAL_CAMERA_TYPES = ('spherical', 'equirectangular')
+
+
+def tag_fields(image_data):
+    """The part of a Graph API answer needed by tag_image."""
+    return {field: image_data.get(field) for field in TAG_FIELDS.split(',')}
+
+
+def picture_metadata(fields):
+    from model import PictureType
+    from writer import PictureMetadata, tz_resolver
+
+    import pytz
+
+    coordinates = (fields.get('computed_geometry') or {}).get('coordinates') or [None, None]
+    longitude, latitude = (list(coordinates) + [None, None])[:2]
+
+    capture_time = None
+    if fields.get('captured_at') is not None:
+        # captured_at is a UTC timestamp in ms; Writer expects the naive local time of the picture
+        capture_time = datetime.fromtimestamp(fields['captured_at'] / 1000, tz=timezone.utc)
+        tz_name = None
+        if latitude is not None and longitude is not None:
+            tz_name = tz_resolver.timezone_at(latitude, longitude)
+        if tz_name:
+            capture_time = capture_time.astimezone(pytz.timezone(tz_name))
+        capture_time = capture_time.replace(tzinfo=None)
+
+    picture_type = None
+    if fields.get('camera_type'):
+        spherical = fields['camera_type'] in SPHERICAL_CAMERA_TYPES
+        picture_type = PictureType.equirectangular if spherical else PictureType.flat
+
+    return PictureMetadata(
+        capture_time=capture_time,
+        longitude=longitude,
+        latitude=latitude,
+        picture_type=picture_type,
+        direction=fields.get('compass_angle'),
+    )
+
+
+def tag_image(content, fields):
+    """Return `content` with GPS position, direction, capture time and projection written in its metadata."""
+    from writer import Writer
+
+    metadata = picture_metadata(fields)
+    with Writer(content) as writer:
+        writer.writePictureMetadata(metadata)
+        writer.add_direction(metadata)
+        writer.apply()
+        return writer.get_Bytes()
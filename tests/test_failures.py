@@ -0,0 +1,67 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import graph_api  # noqa: E402
+import mapillary_download  # noqa: E402
+from failures import GIVE_UP, FailureLog, policy  # noqa: E402
+from fakes import image_ids, serve_mapillary  # noqa: E402
+
+
+def test_batch_with_one_failed_id(tmp_path, monkeypatch):
+    server, base_url = serve_mapillary(1000)
+    monkeypatch.setattr(graph_api, "BASE", base_url)
+    ids = image_ids(20)
+    gone = {ids[3], ids[13]}  # one per batch of 10
+    graph_get = mapillary_download.graph_get
+
+    def get_with_gone_images(url, params):
+        if gone & set(params.get("ids", "").split(",")):
+            raise graph_api.GraphAPIError(404, "Unsupported get request")
+        return graph_get(url, params)
+
+    monkeypatch.setattr(mapillary_download, "graph_get", get_with_gone_images)
+    failures_path = str(tmp_path / "failures.jsonl")
+    try:
+        mapillary_download.main(["token", "--image_ids", *ids, "--sink", "local", "--output_dir", str(tmp_path / "out"),
+                                 "--no_cache", "--metadata_batch_size", "10", "--report_interval", "0",
+                                 "--failures", failures_path])
+    finally:
+        server.shutdown()
+
+    assert sorted(os.listdir(tmp_path / "out")) == sorted(f"{image_id}.jpg" for image_id in ids if image_id not in gone)
+    failed = FailureLog(failures_path).failed
+    assert set(failed) == gone
+    for record in failed.values():
+        assert (record["stage"], record["error"], record["status"]) == ("metadata", "GraphAPIError", 404)
+        assert policy(record) == GIVE_UP
+
+
+def test_retry_run_reports_its_own_counts(tmp_path, monkeypatch):
+    server, base_url = serve_mapillary(1000)
+    monkeypatch.setattr(graph_api, "BASE", base_url)
+    ids = image_ids(10)
+    gone = {ids[2], ids[7]}
+    graph_get = mapillary_download.graph_get
+
+    def get_with_gone_images(url, params):
+        if gone & set(params.get("ids", "").split(",")):
+            raise graph_api.GraphAPIError(503, "Service unavailable")
+        return graph_get(url, params)
+
+    argv = ["token", "--sink", "local", "--output_dir", str(tmp_path / "out"), "--no_cache",
+            "--metadata_batch_size", "1", "--report_interval", "0", "--failures", str(tmp_path / "failures.jsonl")]
+    monkeypatch.setattr(mapillary_download, "graph_get", get_with_gone_images)
+    try:
+        mapillary_download.main(argv + ["--image_ids", *ids])
+        assert mapillary_download.registry.counter("images_uploaded_total").value == 8
+        monkeypatch.setattr(mapillary_download, "graph_get", graph_get)
+        mapillary_download.main(argv + ["--retry_failed"])
+    finally:
+        server.shutdown()
+
+    assert mapillary_download.registry.counter("images_uploaded_total").value == 2
+    assert len(os.listdir(tmp_path / "out")) == 10
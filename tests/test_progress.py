@@ -0,0 +1,33 @@
+import os
+import sqlite3
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import graph_api  # noqa: E402
+import mapillary_download  # noqa: E402
+from fakes import image_ids, serve_mapillary  # noqa: E402
+from progress import ProgressStore  # noqa: E402
+
+
+def test_shard_leased_by_a_stalled_node_is_taken_over(tmp_path, monkeypatch):
+    server, base_url = serve_mapillary(1000)
+    monkeypatch.setattr(graph_api, "BASE", base_url)
+    ids = image_ids(20)
+    progress_path = str(tmp_path / "progress.sqlite")
+    stalled = ProgressStore(progress_path, owner="stalled", lease_seconds=2)
+    assert stalled.acquire((1, 2))  # and never renewed
+    stalled.close()
+    try:
+        mapillary_download.main(["token", "--image_ids", *ids, "--sink", "local", "--output_dir", str(tmp_path / "out"),
+                                 "--no_cache", "--report_interval", "0", "--failures", str(tmp_path / "failures.jsonl"),
+                                 "--shard", "0/2", "--progress", progress_path, "--lease_seconds", "30"])
+    finally:
+        server.shutdown()
+
+    assert sorted(os.listdir(tmp_path / "out")) == sorted(f"{image_id}.jpg" for image_id in ids)
+    with sqlite3.connect(progress_path) as db:
+        rows = db.execute("SELECT shard, completed_at IS NOT NULL FROM shards ORDER BY shard").fetchall()
+    assert rows == [(0, 1), (1, 1)]
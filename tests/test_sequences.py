@@ -0,0 +1,34 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import graph_api  # noqa: E402
+import mapillary_download  # noqa: E402
+from fakes import sequence_ids, serve_mapillary  # noqa: E402
+
+
+def test_no_sequence_listed_past_the_image_limit(tmp_path, monkeypatch):
+    server, base_url = serve_mapillary(1000, images_per_sequence=20)
+    monkeypatch.setattr(graph_api, "BASE", base_url)
+    listed = []
+    graph_get = mapillary_download.graph_get
+
+    def counting_get(url, params):
+        if url.endswith("/image_ids"):
+            listed.append(params["sequence_id"])
+        return graph_get(url, params)
+
+    monkeypatch.setattr(mapillary_download, "graph_get", counting_get)
+    try:
+        mapillary_download.main(["token", "--sequence_ids", *sequence_ids(50), "--sink", "local",
+                                 "--output_dir", str(tmp_path / "out"), "--no_cache", "--report_interval", "0",
+                                 "--failures", str(tmp_path / "failures.jsonl"), "--image_limit", "30",
+                                 "--sequence_workers", "1"])
+    finally:
+        server.shutdown()
+
+    assert len(os.listdir(tmp_path / "out")) == 30
+    assert listed == sequence_ids(2)
@@ -0,0 +1,57 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from sinks import TarShardSink, local_opener  # noqa: E402
+
+
+class Broken(OSError):
+    pass
+
+
+def failing_opener(directory, fail_on):
+    """A local opener whose files raise once `fail_on(name, data)` is true."""
+    opener = local_opener(directory)
+
+    def open_file(name):
+        f = opener(name)
+        write = f.write
+
+        def checked(data):
+            if fail_on(name, data):
+                raise Broken(name)
+            return write(data)
+
+        f.write = checked
+        return f
+
+    return open_file
+
+
+def test_shard_lost_to_a_member_write_reports_its_images(tmp_path):
+    dropped = []
+    sink = TarShardSink(failing_opener(str(tmp_path), lambda name, data: b"second" in data), writers=1,
+                        on_drop=lambda ids, error: dropped.append((ids, type(error))))
+    sink.write("0", b"first" * 10000)  # past the tar stream buffer, so the writes reach the file
+    with pytest.raises(Broken):
+        sink.write("1", b"second" * 10000)
+    assert dropped == [(["0"], Broken)]  # "1" is reported by the caller, whose write raised
+    sink.write("2", b"third")
+    sink.close()
+    assert [s["count"] for s in sink.shards] == [1]
+
+
+def test_shard_lost_when_finished_reports_its_images_and_close_still_writes_the_manifest(tmp_path):
+    dropped, committed = [], []
+    sink = TarShardSink(failing_opener(str(tmp_path), lambda name, data: name.endswith(".index.json")), writers=2,
+                        name="run", on_commit=committed.append, on_drop=lambda ids, error: dropped.append(sorted(ids)))
+    sink.write("0", b"first")
+    sink.write("1", b"second")
+    with pytest.raises(Broken):
+        sink.close()
+    assert sorted(dropped) == [["0"], ["1"]] and committed == []
+    assert os.path.exists(tmp_path / "shards.json")
@@ -0,0 +1,46 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import graph_api  # noqa: E402
+import mapillary_download  # noqa: E402
+from failures import FailureLog  # noqa: E402
+from fakes import image_ids, images_bbox, serve_mapillary  # noqa: E402
+from sync import SyncState, bbox_scope  # noqa: E402
+from tiles import grid  # noqa: E402
+
+
+def test_failed_tile_is_journaled_and_keeps_the_watermark(tmp_path, monkeypatch):
+    server, base_url = serve_mapillary(1000, searchable_images=100)
+    monkeypatch.setattr(graph_api, "BASE", base_url)
+    bbox, tile_size = images_bbox(100), 0.0002
+    broken = grid(bbox, tile_size)[0].bbox  # the south-west tile, which holds the first images
+    graph_get = mapillary_download.graph_get
+
+    def get_with_broken_tile(url, params):
+        if params.get("bbox") == broken:
+            raise graph_api.GraphAPIError(503, "Service unavailable")
+        return graph_get(url, params)
+
+    out, failures_path, state = tmp_path / "out", str(tmp_path / "failures.jsonl"), str(tmp_path / "sync.sqlite")
+    argv = ["token", "--sink", "local", "--output_dir", str(out), "--no_cache", "--report_interval", "0",
+            "--failures", failures_path, "--tile_size", str(tile_size)]
+    monkeypatch.setattr(mapillary_download, "graph_get", get_with_broken_tile)
+    try:
+        mapillary_download.main(argv + ["--bbox", ",".join(map(str, bbox)), "--sync", "--sync_state", state])
+        stored = len(os.listdir(out))
+        assert 0 < stored < 100
+        failed = FailureLog(failures_path).failed
+        assert list(failed) == [broken] and failed[broken]["kind"] == "tile"
+        assert SyncState(state).watermark(bbox_scope(tuple(bbox))) is None
+
+        monkeypatch.setattr(mapillary_download, "graph_get", graph_get)
+        mapillary_download.main(argv + ["--retry_failed"])
+    finally:
+        server.shutdown()
+
+    assert sorted(os.listdir(out)) == sorted(f"{image_id}.jpg" for image_id in image_ids(100))
+    assert FailureLog(failures_path).failed == {}
@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from timezones import TimezoneResolver  # noqa: E402
+
+
+@pytest.mark.parametrize("lat, lon, name", [
+    (41.95, -7.0578, "Europe/Madrid"),
+    (28.6706, 84.702, "Asia/Kathmandu"),
+    (27.2641, 92.0465, "Asia/Kolkata"),
+])
+def test_point_near_a_border(lat, lon, name):
+    resolver = TimezoneResolver()
+    assert resolver.timezone_at(lat, lon) == name
+    assert resolver.timezones_at([lat], [lon]) == [name]
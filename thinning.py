@@ -0,0 +1,92 @@
+"""
+Spatial thinning of the images to download: keep one image every N meters.
+
+Images are considered in the order they come out of the metadata stage. An
+image is dropped when an already accepted image, from any sequence, lies
+within `distance` meters of it and, with `max_heading_delta`, looks in the
+same direction (compass angles within that many degrees). Images without a
+position are always kept; an image without a heading, or from a spherical
+camera, is a duplicate of any accepted image close enough.
+
+Accepted images are kept in a grid of rows `distance` meters high, cut in
+columns of a fixed longitude width per row, at least `distance` meters wide
+(measured at the row's poleward edge). A check only looks at the cells of
+the 3 rows around the image that overlap its `distance` reach, a few cells.
+"""
+import math
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from tagging import SPHERICAL_CAMERA_TYPES
+
+THIN_FIELDS = 'computed_geometry,compass_angle,camera_type'
+
+EARTH_RADIUS = 6371008.8  # meters
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+
+def distance_m(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+    """Haversine distance in meters."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def heading_delta(a: float, b: float) -> float:
+    """Smallest angle in degrees between two compass headings."""
+    delta = abs(a - b) % 360
+    return min(delta, 360 - delta)
+
+
+def position_and_heading(image_data: dict) -> Tuple[Optional[Tuple[float, float]], Optional[float]]:
+    """((lon, lat) or None, compass angle or None) of a Graph API image answer."""
+    coordinates = (image_data.get('computed_geometry') or {}).get('coordinates')
+    position = (coordinates[0], coordinates[1]) if coordinates and len(coordinates) >= 2 else None
+    heading = image_data.get('compass_angle')
+    if (heading is not None and heading < 0) or image_data.get('camera_type') in SPHERICAL_CAMERA_TYPES:
+        heading = None  # unknown (Mapillary answers -1), or a panorama that looks everywhere
+    return position, heading
+
+
+class Thinner:
+    def __init__(self, distance: float, max_heading_delta: Optional[float] = None) -> None:
+        self.distance = distance
+        self.max_heading_delta = max_heading_delta
+        self.cells: Dict[Tuple[int, int], List[Tuple[float, float, Optional[float]]]] = {}
+        self.lock = threading.Lock()
+
+    def _row(self, lat: float) -> int:
+        return math.floor(lat * METERS_PER_DEGREE / self.distance)
+
+    def _column(self, lon: float, row: int) -> int:
+        # meters per degree of longitude at the poleward edge of the row, where they are the fewest
+        edge = min(max(abs(row), abs(row + 1)) * self.distance / METERS_PER_DEGREE, 90.0)
+        return math.floor(lon * METERS_PER_DEGREE * math.cos(math.radians(edge)) / self.distance)
+
+    def _duplicate(self, lon: float, lat: float, heading: Optional[float], other) -> bool:
+        other_lon, other_lat, other_heading = other
+        if distance_m(lon, lat, other_lon, other_lat) > self.distance:
+            return False
+        if self.max_heading_delta is None or heading is None or other_heading is None:
+            return True
+        return heading_delta(heading, other_heading) <= self.max_heading_delta
+
+    def accept(self, image_data: dict) -> bool:
+        """False if the image is redundant with one accepted before; accepted images are remembered."""
+        position, heading = position_and_heading(image_data)
+        if position is None:
+            return True
+        lon, lat = position
+        row = self._row(lat)
+        # longitudes within `distance` of the image, the widest at the most poleward latitude in reach
+        reach = self.distance / METERS_PER_DEGREE
+        span = reach / max(math.cos(math.radians(min(abs(lat) + reach, 90.0))), 1e-9)
+        with self.lock:
+            for r in (row - 1, row, row + 1):
+                for column in range(self._column(lon - span, r), self._column(lon + span, r) + 1):
+                    for other in self.cells.get((r, column), ()):
+                        if self._duplicate(lon, lat, heading, other):
+                            return False
+            self.cells.setdefault((row, self._column(lon, row)), []).append((lon, lat, heading))
+        return True
@@ -0,0 +1,154 @@
+"""
+Image discovery over a bounding box with the Graph API `images?bbox=` search.
+
+The search answers at most `limit` images per request without paging, so
+the box is cut into tiles searched concurrently, and a tile whose answer is
+full is split in four until every answer is complete.
+
+The search includes images lying on a tile edge, so neighbouring tiles can
+both return them. Each tile only keeps the images it owns: those in its
+half-open rectangle [west, east) x [south, north), the edges on the border
+of the whole box being closed. An image whose position is missing or falls
+outside the tile that returned it (the search may use another geometry than
+the one returned) cannot be placed; those few are deduplicated with a set.
+
+A tile whose search fails (after the retries of the Graph API client) is
+searched again up to `retries` times, then handed to `on_error` and skipped:
+one failed tile does not end the listing of the whole box.
+"""
+import concurrent.futures
+import math
+from dataclasses import dataclass
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import graph_api
+
+MAX_RESULTS = 2000  # the images search never answers more
+DEFAULT_TILE_SIZE = 0.05  # degrees
+MIN_TILE_SIZE = 0.0005  # about 50 m: a full tile this small is kept as it is, with a warning
+BBOX_FIELDS = "id,geometry,computed_geometry"
+
+
+@dataclass(frozen=True)
+class Tile:
+    west: float
+    south: float
+    east: float
+    north: float
+    closed_east: bool = False
+    closed_north: bool = False
+
+    @property
+    def bbox(self) -> str:
+        return f"{self.west},{self.south},{self.east},{self.north}"
+
+    def owns(self, lon: float, lat: float) -> bool:
+        in_lon = self.west <= lon < self.east or (self.closed_east and lon == self.east)
+        in_lat = self.south <= lat < self.north or (self.closed_north and lat == self.north)
+        return in_lon and in_lat
+
+    def contains(self, lon: float, lat: float) -> bool:
+        return self.west <= lon <= self.east and self.south <= lat <= self.north
+
+    def split(self) -> List["Tile"]:
+        lon, lat = (self.west + self.east) / 2, (self.south + self.north) / 2
+        return [
+            Tile(self.west, self.south, lon, lat),
+            Tile(lon, self.south, self.east, lat, closed_east=self.closed_east),
+            Tile(self.west, lat, lon, self.north, closed_north=self.closed_north),
+            Tile(lon, lat, self.east, self.north, closed_east=self.closed_east, closed_north=self.closed_north),
+        ]
+
+
+def parse_bbox(text: str) -> Tuple[float, float, float, float]:
+    """'west,south,east,north' in degrees."""
+    west, south, east, north = (float(value) for value in text.split(","))
+    if not (-180 <= west < east <= 180 and -90 <= south < north <= 90):
+        raise ValueError(f"Invalid bounding box {text!r}: expected west,south,east,north")
+    return west, south, east, north
+
+
+def grid(bbox: Tuple[float, float, float, float], tile_size: float = DEFAULT_TILE_SIZE) -> List[Tile]:
+    """Cut the box into tiles of about `tile_size` degrees; the ones on its east and north border are closed there."""
+    west, south, east, north = bbox
+    columns = max(1, math.ceil((east - west) / tile_size))
+    rows = max(1, math.ceil((north - south) / tile_size))
+    lons = [west + (east - west) * i / columns for i in range(columns)] + [east]
+    lats = [south + (north - south) * j / rows for j in range(rows)] + [north]
+    return [Tile(lons[i], lats[j], lons[i + 1], lats[j + 1], closed_east=i == columns - 1, closed_north=j == rows - 1)
+            for j in range(rows) for i in range(columns)]
+
+
+def _position(image: dict) -> Optional[Tuple[float, float]]:
+    for field in ("geometry", "computed_geometry"):
+        coordinates = (image.get(field) or {}).get("coordinates")
+        if coordinates and len(coordinates) >= 2:
+            return coordinates[0], coordinates[1]
+    return None
+
+
+class TileSearchError(Exception):
+    def __init__(self, tile: Tile, error: Exception) -> None:
+        super().__init__(f"{tile.bbox}: {error}")
+        self.tile = tile
+        self.error = error
+
+
+def search_tile(get_json: graph_api.GetJson, tile: Tile, limit: int = MAX_RESULTS,
+                params: Optional[dict] = None) -> List[dict]:
+    """`params` adds search filters, e.g. start_captured_at."""
+    data = get_json(f"{graph_api.BASE}/images",
+                    {"bbox": tile.bbox, "fields": BBOX_FIELDS, "limit": limit, **(params or {})}) or {}
+    return data.get("data", [])
+
+
+def iter_bbox_image_ids(get_json: graph_api.GetJson, bbox: Tuple[float, float, float, float],
+                        tile_size: float = DEFAULT_TILE_SIZE, workers: int = 8, limit: int = MAX_RESULTS,
+                        min_tile_size: float = MIN_TILE_SIZE, params: Optional[dict] = None, retries: int = 2,
+                        on_error: Optional[Callable[[Tile, Exception], None]] = None) -> Iterator[str]:
+    """
+    Yield the ID of every image in `bbox` once, as the tile searches complete.
+    At most `2 * workers` searches are in flight; full tiles are split and searched again.
+    """
+    tiles = grid(bbox, tile_size)
+    unplaced = set()
+    attempts = {}  # tile -> failed searches
+
+    def search(tile):
+        try:
+            return tile, search_tile(get_json, tile, limit, params)
+        except Exception as e:
+            raise TileSearchError(tile, e)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        while tiles or pending:
+            while tiles and len(pending) < 2 * workers:
+                pending.add(executor.submit(search, tiles.pop()))
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                try:
+                    tile, images = future.result()
+                except TileSearchError as e:
+                    attempts[e.tile] = attempts.get(e.tile, 0) + 1
+                    if attempts[e.tile] <= retries:
+                        tiles.append(e.tile)
+                    elif on_error is not None:
+                        on_error(e.tile, e.error)
+                    else:
+                        print(f"⚠️ Search of tile {e.tile.bbox} failed, its images are missed: {e.error}")
+                    continue
+                if len(images) >= limit:
+                    if tile.east - tile.west > min_tile_size or tile.north - tile.south > min_tile_size:
+                        tiles.extend(tile.split())
+                        continue
+                    print(f"⚠️ Tile {tile.bbox} still answers {len(images)} images at the minimum size, some may be missed")
+                for image in images:
+                    position = _position(image)
+                    if position is not None and tile.contains(*position):
+                        if tile.owns(*position):
+                            yield image["id"]
+                        continue
+                    if image["id"] not in unplaced:
+                        unplaced.add(image["id"])
+                        yield image["id"]
@@ -0,0 +1,86 @@
+"""
+Cached timezone lookup for picture coordinates.
+
+`timezonefinder` answers with a point-in-polygon test, which is expensive
+to repeat for thousands of pictures taken a few meters apart. The resolver
+splits the world in square cells of `cell_size` degrees. The first lookup in
+a cell checks the finder's shortcuts, the H3 hexagons for which it stores
+the zones they intersect: if every hexagon overlapping the cell holds one
+and the same zone, so does the whole cell, which is cached as uniform and
+later lookups in it are a dict access. Other cells may cross a timezone
+border and their points are always resolved exactly.
+"""
+import math
+from typing import Dict, Iterable, List, Optional, Tuple
+
+DEFAULT_CELL_SIZE = 0.05  # degrees, about 5 km
+
+_BORDER = object()
+_MISSING = object()
+
+
+class TimezoneResolver:
+    def __init__(self, finder=None, cell_size: float = DEFAULT_CELL_SIZE) -> None:
+        self._finder = finder
+        self.cell_size = cell_size
+        # plain dict reads/writes are atomic, so threads can share the cache; two threads classifying
+        # the same new cell at once just do the work twice
+        self.cells: Dict[Tuple[int, int], object] = {}
+
+    @property
+    def finder(self):
+        if self._finder is None:
+            import timezonefinder  # type: ignore
+
+            self._finder = timezonefinder.TimezoneFinder()
+        return self._finder
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return math.floor(lat / self.cell_size), math.floor(lon / self.cell_size)
+
+    def _classify(self, cell: Tuple[int, int]) -> object:
+        """Timezone name of a cell, or _BORDER unless every shortcut hexagon overlapping it holds that zone only."""
+        import h3  # installed with timezonefinder
+        from timezonefinder.configs import SHORTCUT_H3_RES
+
+        south, west = cell[0] * self.cell_size, cell[1] * self.cell_size
+        north, east = min(90.0, south + self.cell_size), min(180.0, west + self.cell_size)
+        if south >= north or west >= east:
+            return _BORDER
+        box = h3.LatLngPoly([(south, west), (south, east), (north, east), (north, west)])
+        names = set()
+        for hexagon in h3.h3shape_to_cells_experimental(box, SHORTCUT_H3_RES, contain='overlap'):
+            lat, lon = h3.cell_to_latlng(hexagon)
+            names.add(self.finder.unique_timezone_at(lng=lon, lat=lat))  # None: several zones, or none
+            if len(names) > 1 or None in names:
+                return _BORDER
+        return names.pop() if names else _BORDER
+
+    def _cell_timezone(self, cell: Tuple[int, int]) -> object:
+        value = self.cells.get(cell, _MISSING)
+        if value is _MISSING:
+            value = self.cells[cell] = self._classify(cell)
+        return value
+
+    def timezone_at(self, lat: float, lon: float) -> Optional[str]:
+        """Timezone name (e.g. 'Europe/Paris') at a position, or None."""
+        value = self._cell_timezone(self._cell(lat, lon))
+        if value is _BORDER:
+            return self.finder.timezone_at(lng=lon, lat=lat)
+        return value
+
+    def timezones_at(self, latitudes: Iterable[float], longitudes: Iterable[float]) -> List[Optional[str]]:
+        """
+        Resolve a whole sequence at once: every distinct cell is classified a
+        single time, only points in border cells get an exact lookup.
+        Positions with a None coordinate resolve to None.
+        """
+        names = []
+        cell_size = self.cell_size
+        for lat, lon in zip(latitudes, longitudes):
+            if lat is None or lon is None:
+                names.append(None)
+                continue
+            value = self._cell_timezone((math.floor(lat / cell_size), math.floor(lon / cell_size)))
+            names.append(self.finder.timezone_at(lng=lon, lat=lat) if value is _BORDER else value)
+        return names
@@ -0,0 +1,107 @@
+"""
+Bounded-memory transfers to S3.
+
+An image is piped chunk by chunk into an S3 multipart upload, so at most one
+part is held in memory per transfer no matter how big the object is. Objects
+smaller than one part are sent with a single PutObject.
+"""
+from typing import Iterable
+
+MiB = 1024 * 1024
+DEFAULT_CHUNK_SIZE = 256 * 1024
+DEFAULT_PART_SIZE = 8 * MiB
+MIN_PART_SIZE = 5 * MiB  # S3 rejects smaller parts, except for the last one
+
+
+class S3MultipartWriter:
+    """
+    Write-only file object backed by an S3 multipart upload.
+
+    The multipart upload is only created once a full part is buffered; if the
+    writer is closed before that the data goes out as a plain PutObject.
+    Leaving the `with` block on an exception aborts the upload.
+    """
+
+    def __init__(self, s3_client, bucket_name: str, key_name: str, part_size: int = DEFAULT_PART_SIZE) -> None:
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f"part_size must be at least {MIN_PART_SIZE} bytes, got {part_size}")
+        self.s3 = s3_client
+        self.bucket_name = bucket_name
+        self.key_name = key_name
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.size = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.size
+
+    def write(self, data) -> int:
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.part_size:
+            with memoryview(self.buffer) as view:
+                part = bytes(view[:self.part_size])
+            del self.buffer[:self.part_size]
+            self._upload_part(part)
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        if self.upload_id is None:
+            self.s3.put_object(Bucket=self.bucket_name, Key=self.key_name, Body=bytes(self.buffer))
+            self.buffer = bytearray()
+            return
+        try:
+            if self.buffer:
+                self._upload_part(bytes(self.buffer))
+            self.s3.complete_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key_name, UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts},
+            )
+        except Exception:
+            self.abort()
+            raise
+        self.buffer = bytearray()
+
+    def abort(self) -> None:
+        self.closed = True
+        self.buffer = bytearray()
+        if self.upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key_name, UploadId=self.upload_id)
+
+    def _upload_part(self, body: bytes) -> None:
+        if self.upload_id is None:
+            self.upload_id = self.s3.create_multipart_upload(Bucket=self.bucket_name, Key=self.key_name)["UploadId"]
+        number = len(self.parts) + 1
+        r = self.s3.upload_part(Bucket=self.bucket_name, Key=self.key_name, UploadId=self.upload_id,
+                                PartNumber=number, Body=body)
+        self.parts.append({"ETag": r["ETag"], "PartNumber": number})
+
+
+def stream_to_s3(s3_client, chunks: Iterable[bytes], bucket_name: str, key_name: str,
+                 part_size: int = DEFAULT_PART_SIZE) -> int:
+    """Upload an iterable of byte chunks to s3://bucket_name/key_name, return the number of bytes sent."""
+    with S3MultipartWriter(s3_client, bucket_name, key_name, part_size=part_size) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    return writer.size
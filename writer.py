@@ -1,8 +1,10 @@
 #source : https://gitlab.com/geovisio/geo-picture-tag-reader/-/blob/main/geopic_tag_reader/writer.py
-from typing import Optional, Tuple
+from typing import Dict, List, Optional, Sequence, Tuple
 from datetime import datetime, timedelta
 from dataclasses import dataclass
+from functools import lru_cache
 from model import PictureType
+from timezones import TimezoneResolver
 
 try:
     import pyexiv2  # type: ignore
@@ -16,6 +18,7 @@ import pytz
 
 
 tz_finder = timezonefinder.TimezoneFinder()
+tz_resolver = TimezoneResolver(tz_finder)  # cached lookups, pictures of a sequence share a few grid cells
 
 
 @dataclass
@@ -31,6 +34,33 @@ class PictureMetadata:
     direction: Optional[float] = None
     orientation: Optional[int] = 1
 
+@lru_cache(maxsize=65536)
+def _limit_denominator(value: float, max_denominator: int = 1000000) -> Tuple[int, int]:
+    """Same result as Fraction.from_float(value).limit_denominator(max_denominator).as_integer_ratio(),
+    computed on plain integers
+    >>> _limit_denominator(22.0884)
+    (55221, 2500)
+    """
+    n, d = value.as_integer_ratio()
+    if d <= max_denominator:
+        return n, d
+    num, den = n, d
+    p0, q0, p1, q1 = 0, 1, 1, 0
+    while True:
+        a = num // den
+        q2 = q0 + a * q1
+        if q2 > max_denominator:
+            break
+        p0, q0, p1, q1 = p1, q1, p0 + a * p1, q2
+        num, den = den, num - a * den
+    k = (max_denominator - q0) // q1
+    p, q = p0 + k * p1, q0 + k * q1
+    # closest of p1/q1 and p/q to n/d, ties going to p1/q1 like Fraction.limit_denominator
+    if abs(p1 * d - n * q1) * q <= abs(p * d - n * q) * q1:
+        return p1, q1
+    return p, q
+
+
 class Writer():
     def __init__(self, picture: bytes) -> None:
         self.content = picture
@@ -213,7 +243,7 @@ class Writer():
             except KeyError:
                 return metadata.capture_time # canot localize, returning same date 
 
-        tz_name = tz_finder.timezone_at(lng=lon, lat=lat)
+        tz_name = tz_resolver.timezone_at(lat, lon)
         if not tz_name:
             return metadata.capture_time  # cannot find timezone, returning same date
 
@@ -265,3 +295,119 @@ class Writer():
         f = Fraction.from_float(s).limit_denominator()  # limit fraction precision
         num_s, denomim_s = f.as_integer_ratio()
         return f"{d}/1 {m}/1 {num_s}/{denomim_s}"
+
+    @classmethod
+    def encode_batch(
+        cls,
+        latitudes: Sequence[Optional[float]],
+        longitudes: Sequence[Optional[float]],
+        altitudes: Optional[Sequence[Optional[float]]] = None,
+        directions: Optional[Sequence[Optional[float]]] = None,
+        capture_times: Optional[Sequence[Optional[datetime]]] = None,
+    ) -> List[Dict[str, object]]:
+        """
+        Compute the exif tags of a whole sequence at once.
+
+        Returns for every picture the dict that writePictureMetadata + add_altitude + add_direction
+        would put in `updated_exif` (ready for `modify_exif`). DMS, altitude and direction values are
+        computed on numpy arrays, timezones are resolved once per grid cell and capture times are
+        formatted from datetime64 arrays. Pictures without coordinates are handled as pictures
+        without GPS exif tags.
+        """
+        import numpy as np
+
+        n = len(latitudes)
+        altitudes = altitudes if altitudes is not None else [None] * n
+        directions = directions if directions is not None else [None] * n
+        capture_times = capture_times if capture_times is not None else [None] * n
+        results: List[Dict[str, object]] = [{} for _ in range(n)]
+
+        # same early exit as writePictureMetadata (which also looks at picture_type, an xmp tag)
+        written = [bool(capture_times[i] or longitudes[i] or latitudes[i]) for i in range(n)]
+        positioned = [i for i in range(n)
+                      if written[i] and latitudes[i] is not None and longitudes[i] is not None]
+        has_position = set(positioned)
+        helper = cls.__new__(cls)
+
+        # capture times, see add_gps_datetime / add_datetimeoriginal
+        timed = [i for i in range(n) if written[i] and capture_times[i] and capture_times[i].utcoffset() is None]
+        tz_names = tz_resolver.timezones_at(
+            [latitudes[i] if i in has_position else None for i in timed],
+            [longitudes[i] if i in has_position else None for i in timed],
+        )
+        local_times, offsets, localized = [], [], []
+        minute_offsets = {}
+        for i, tz_name in zip(timed, tz_names):
+            if tz_name is None or not 1000 <= capture_times[i].year <= 9999:
+                # not localized: the per-picture methods depend on the system timezone here, reuse them
+                writer = cls.__new__(cls)
+                writer.exif, writer.updated_exif = {}, {}
+                metadata = PictureMetadata(capture_time=capture_times[i])
+                writer.add_gps_datetime(metadata)
+                writer.add_datetimeoriginal(metadata)
+                results[i].update(writer.updated_exif)
+                continue
+            # offsets only change on whole minutes since 1970: pictures of the same minute share one lookup
+            capture_time = capture_times[i]
+            minute = (tz_name, capture_time.replace(second=0, microsecond=0)) if capture_time.year >= 1970 else None
+            offset = minute_offsets.get(minute)
+            if offset is None:
+                offset = pytz.timezone(tz_name).localize(capture_time).utcoffset()
+                if minute is not None:
+                    minute_offsets[minute] = offset
+            local_times.append(capture_times[i])
+            offsets.append(offset)
+            localized.append(i)
+        if localized:
+            local = np.array(local_times, dtype="datetime64[us]")
+            utc = local - np.array(offsets, dtype="timedelta64[us]")
+            local_str = np.datetime_as_string(local, unit="s")
+            utc_str = np.datetime_as_string(utc, unit="s")
+            formatted_offsets = {}
+            for i, offset, ls, us in zip(localized, offsets, local_str, utc_str):
+                if offset not in formatted_offsets:
+                    formatted_offsets[offset] = helper.format_offset(offset)
+                results[i]["Exif.Photo.DateTimeOriginal"] = f"{ls[0:4]}:{ls[5:7]}:{ls[8:10]} {ls[11:19]}"
+                results[i]["Exif.Photo.OffsetTimeOriginal"] = formatted_offsets[offset]
+                results[i]["Exif.GPSInfo.GPSDateStamp"] = f"{us[0:4]}:{us[5:7]}:{us[8:10]}"
+                results[i]["Exif.GPSInfo.GPSTimeStamp"] = f"{us[11:13]}/1 {us[14:16]}/1 {us[17:19]}/1"
+
+        # coordinates, see add_lat_lon / _to_dms / _to_exif_dms
+        if positioned:
+            values = np.array([[latitudes[i], longitudes[i]] for i in positioned], dtype=np.float64)
+            absolute = np.abs(values)
+            degrees = np.trunc(absolute)
+            minutes = (absolute - degrees) * 60
+            seconds = (minutes - np.trunc(minutes)) * 60
+            degrees, minutes = degrees.astype(np.int64).tolist(), np.trunc(minutes).astype(np.int64).tolist()
+            seconds = seconds.tolist()
+            for row, i in enumerate(positioned):
+                lat, lon = latitudes[i], longitudes[i]
+                exif = results[i]
+                for axis, (ref_key, key, ref) in enumerate((
+                    ("Exif.GPSInfo.GPSLatitudeRef", "Exif.GPSInfo.GPSLatitude", "N" if lat > 0 else "S"),
+                    ("Exif.GPSInfo.GPSLongitudeRef", "Exif.GPSInfo.GPSLongitude", "E" if lon > 0 else "W"),
+                )):
+                    # Python's round() is exact decimal rounding, numpy's is not: keep it per value
+                    num, den = _limit_denominator(round(seconds[row][axis], 8))
+                    exif[ref_key] = ref
+                    exif[key] = f"{degrees[row][axis]}/1 {minutes[row][axis]}/1 {num}/{den}"
+
+        # altitude and direction, see add_altitude / add_direction
+        precision = 1000
+        with_altitude = [i for i in range(n) if altitudes[i] is not None]
+        if with_altitude:
+            values = np.array([altitudes[i] for i in with_altitude], dtype=np.float64)
+            encoded = np.trunc(np.abs(values * precision)).astype(np.int64).tolist()
+            for i, value, altitude in zip(with_altitude, encoded, values.tolist()):
+                results[i]["Exif.GPSInfo.GPSAltitude"] = f"{value} / {precision}"
+                results[i]["Exif.GPSInfo.GPSAltitudeRef"] = 0 if altitude >= 0 else 1
+        with_direction = [i for i in range(n) if directions[i] is not None]
+        if with_direction:
+            values = np.array([directions[i] for i in with_direction], dtype=np.float64)
+            encoded = np.trunc(np.abs(np.mod(values, 360.0) * precision)).astype(np.int64).tolist()
+            for i, value in zip(with_direction, encoded):
+                results[i]["Exif.GPSInfo.GPSImgDirection"] = f"{value} / {precision}"
+                results[i]["Exif.GPSInfo.GPSImgDirectionRef"] = "T"
+
+        return results